@@ -110,13 +110,13 @@ def video_capture(frame_queue, darknet_image_queue):
         ret, frame = cap.read()
         if not ret:
             break
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame_resized = cv2.resize(frame_rgb, (darknet_width, darknet_height),
-                                   interpolation=cv2.INTER_LINEAR)
+        slot = image_pool.acquire()
+        cv2.resize(frame, (darknet_width, darknet_height), dst=slot.resized,
+                   interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(slot.resized, cv2.COLOR_BGR2RGB, dst=slot.rgb)
+        slot.upload()
         frame_queue.put(frame)
-        img_for_detect = darknet.make_image(darknet_width, darknet_height, 3)
-        darknet.copy_image_from_bytes(img_for_detect, frame_resized.tobytes())
-        darknet_image_queue.put(img_for_detect)
+        darknet_image_queue.put(slot)
     cap.release()
 
 
@@ -124,9 +124,9 @@ def inference(darknet_image_queue, detections_queue, fps_queue):
     elapsed_time = 0
     frames = 1
     while cap.isOpened():
-        darknet_image = darknet_image_queue.get()
+        slot = darknet_image_queue.get()
         prev_time = time.time()
-        detections = darknet.detect_image(network, class_names, darknet_image, thresh=args.thresh)
+        detections = darknet.detect_image(network, class_names, slot.image, thresh=args.thresh)
         elapsed_time += time.time() - prev_time
         detections_queue.put(detections)
         fps = int(1/(time.time() - prev_time))
@@ -136,7 +136,7 @@ def inference(darknet_image_queue, detections_queue, fps_queue):
         ))
         frames += 1
         darknet.print_detections(detections, args.ext_output)
-        darknet.free_image(darknet_image)
+        image_pool.release(slot)
     cap.release()
 
 
@@ -180,6 +180,8 @@ if __name__ == '__main__':
         )
     darknet_width = darknet.network_width(network)
     darknet_height = darknet.network_height(network)
+    # one slot in inference, the other filled and queued by video_capture
+    image_pool = darknet.ImagePool(darknet_width, darknet_height, size=2)
     input_path = str2int(args.input)
     cap = cv2.VideoCapture(input_path)
     video_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
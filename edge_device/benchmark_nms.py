@@ -0,0 +1,89 @@
+import argparse
+from ctypes import POINTER, c_float, cast
+import time
+
+import numpy as np
+
+import darknet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="NMS benchmark: do_nms_sort vs non_max_suppression_fast vs nms_array")
+    parser.add_argument("--boxes", type=int, nargs="+", default=[10, 50, 200, 500],
+                        help="number of boxes per frame")
+    parser.add_argument("--classes", type=int, default=4, help="number of classes")
+    parser.add_argument("--repeat", type=int, default=200, help="frames per measurement")
+    parser.add_argument("--thresh", type=float, default=.45, help="NMS overlap threshold")
+    return parser.parse_args()
+
+
+def random_detections(num, classes, rng):
+    """
+    Clustered random boxes in network coordinates as an (N, 6) array, one class per box
+    """
+    centres = rng.uniform(0, 416, (max(num // 4, 1), 2))
+    xy = centres[rng.integers(0, len(centres), num)] + rng.normal(0, 8, (num, 2))
+    wh = rng.uniform(20, 80, (num, 2))
+    dets = np.empty((num, 6), dtype=np.float32)
+    dets[:, :2] = xy - wh / 2
+    dets[:, 2:4] = xy + wh / 2
+    dets[:, 4] = rng.uniform(.3, 1, num)
+    dets[:, 5] = rng.integers(0, classes, num)
+    return dets
+
+
+def to_darknet(dets, classes):
+    """
+    Build a DETECTION array as returned by get_network_boxes, the prob buffers are kept alive by the caller
+    """
+    detections = (darknet.DETECTION * len(dets))()
+    probs = []
+    for j, (x1, y1, x2, y2, score, cls) in enumerate(dets):
+        prob = (c_float * classes)()
+        prob[int(cls)] = score
+        probs.append(prob)
+        detections[j].bbox = darknet.BOX((x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1)
+        detections[j].classes = classes
+        detections[j].best_class_idx = int(cls)
+        detections[j].objectness = score
+        detections[j].prob = cast(prob, POINTER(c_float))
+    return detections, probs
+
+
+def to_tuples(dets):
+    """
+    Input format of non_max_suppression_fast
+    """
+    return [(str(int(cls)), score, None, ((x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1))
+            for x1, y1, x2, y2, score, cls in dets.tolist()]
+
+
+def measure(fn, inputs):
+    start = time.perf_counter()
+    for item in inputs:
+        fn(item)
+    return (time.perf_counter() - start) / len(inputs) * 1000
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{'boxes':>6} {'do_nms_sort':>12} {'nms_fast':>12} {'nms_array':>12}   (ms per frame)")
+    for num in args.boxes:
+        frames = [random_detections(num, args.classes, rng) for _ in range(args.repeat)]
+
+        # do_nms_sort zeroes probabilities in place, every frame gets its own copy,
+        # it is only measured when libdarknet could be loaded
+        c_ms = "n/a"
+        if darknet.lib is not None:
+            c_inputs = [to_darknet(dets, args.classes) for dets in frames]
+            c_ms = f"{measure(lambda d: darknet.do_nms_sort(cast(d[0], POINTER(darknet.DETECTION)), num, args.classes, args.thresh), c_inputs):.3f}"
+        fast_ms = measure(lambda d: darknet.non_max_suppression_fast(d, args.thresh), [to_tuples(dets) for dets in frames])
+        array_ms = measure(lambda d: darknet.nms_array(d, args.thresh), frames)
+
+        print(f"{num:>6} {c_ms:>12} {fast_ms:>12.3f} {array_ms:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
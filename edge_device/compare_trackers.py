@@ -0,0 +1,112 @@
+import argparse
+
+import numpy as np
+
+from sort import BatchSort, Sort, associate_detections_to_trackers
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Regression check: Sort and BatchSort must give identical tracks")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2, 3, 4], help="random scenes to replay")
+    parser.add_argument("--objects", type=int, default=60, help="objects per scene")
+    parser.add_argument("--frames", type=int, default=200, help="frames per scene")
+    parser.add_argument("--miss", type=float, default=.4, help="probability an object is not detected in a frame")
+    parser.add_argument("--detect-every", type=int, default=3, help="frames between detections, the others coast")
+    parser.add_argument("--gating", action="store_true", help="use spatially gated association")
+    parser.add_argument("--scenes", type=int, default=300,
+                        help="crowded scenes where gated and dense association must give the same matches")
+    return parser.parse_args()
+
+
+def scene(rng, objects, frames, miss):
+    """
+    Noisy (N, 6) detections of objects moving at constant velocity, some of them missed in every frame
+    """
+    pos = rng.uniform(0, 1500, (objects, 2))
+    vel = rng.normal(0, 3, (objects, 2))
+    size = rng.uniform(20, 80, (objects, 2))
+    for _ in range(frames):
+        pos += vel
+        seen = rng.random(objects) >= miss
+        boxes = np.concatenate([pos - size / 2, pos + size / 2], axis=1)[seen]
+        boxes += rng.normal(0, 1.5, boxes.shape)
+        dets = np.zeros((len(boxes), 6), dtype=np.float32)
+        dets[:, :4] = boxes
+        dets[:, 4] = rng.uniform(.5, 1, len(boxes))
+        yield dets
+
+
+def replay(tracker, frames, detect_every):
+    outputs, ended = [], []
+    for n, dets in enumerate(frames):
+        outputs.append(tracker.update(dets) if n % detect_every == 0 else tracker.coast())
+        ended.append(list(tracker.pop_ended()))
+    return outputs, ended
+
+
+def compare(seed, args) -> bool:
+    frames = list(scene(np.random.default_rng(seed), args.objects, args.frames, args.miss))
+    expected, expected_ended = replay(Sort(max_age=7, gating=args.gating), frames, args.detect_every)
+    actual, actual_ended = replay(BatchSort(max_age=7, gating=args.gating), frames, args.detect_every)
+
+    # track ids are random uuids, they have to correspond one to one
+    ids = {}
+    for n, (a, b) in enumerate(zip(expected, actual)):
+        if a.shape != b.shape or not np.array_equal(a[:, :4].astype(float), b[:, :4].astype(float)):
+            print(f"seed {seed}: frame {n} boxes differ")
+            return False
+        for id_a, id_b in zip(a[:, 4], b[:, 4]):
+            if ids.setdefault(id_a, id_b) != id_b:
+                print(f"seed {seed}: frame {n} track ids differ")
+                return False
+        if [ids.get(id) for id in expected_ended[n]] != actual_ended[n]:
+            print(f"seed {seed}: frame {n} ended tracks differ")
+            return False
+    print(f"seed {seed}: identical, {len(ids)} tracks")
+    return True
+
+
+def crowded_scene(rng):
+    """
+    100-300 trackers and detections on a small area, most detections near a tracker, some new
+    """
+    num_trk, num_det = rng.integers(100, 301, 2)
+    centres = rng.uniform(0, 800, (num_trk, 2))
+    size = rng.uniform(20, 80, (num_trk, 2))
+    trackers = np.concatenate([centres - size / 2, centres + size / 2], axis=1)
+    source = rng.integers(0, num_trk, num_det)
+    detections = trackers[source] + rng.normal(0, 10, (num_det, 4))
+    new = rng.random(num_det) < .2
+    new_centres = rng.uniform(0, 800, (new.sum(), 2))
+    detections[new] = np.concatenate([new_centres - 25, new_centres + 25], axis=1)
+    return np.c_[detections, np.ones(num_det)], np.c_[trackers, np.zeros(num_trk)]
+
+
+def compare_association(args) -> bool:
+    """
+    Sort and BatchSort share the association, so --gating cannot tell whether gating changes the
+    tracks, here the gated matches are compared to the dense ones directly
+    """
+    rng = np.random.default_rng(0)
+    differ = 0
+    for n in range(args.scenes):
+        detections, trackers = crowded_scene(rng)
+        dense = associate_detections_to_trackers(detections, trackers, 0.3, gating=False)[0]
+        gated = associate_detections_to_trackers(detections, trackers, 0.3, gating=True)[0]
+        if set(map(tuple, dense.tolist())) != set(map(tuple, gated.tolist())):
+            print(f"scene {n}: gated and dense matches differ")
+            differ += 1
+    print(f"association: {args.scenes - differ}/{args.scenes} scenes identical")
+    return differ == 0
+
+
+def main():
+    args = parse_args()
+    results = [compare(seed, args) for seed in args.seeds]
+    results.append(compare_association(args))
+    if not all(results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
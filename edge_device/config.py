@@ -1,9 +1,15 @@
+from typing import List, Tuple
+
 from geotools import Point
+from streams import Stream
 
 device_id: int      = 1
 config_file: str    = 'yolov4-tiny-detrac.cfg'
 data_file: str      = 'obj.data'
 weights: str        = 'yolov4-tiny-detrac_best.weights'
+detector: str       = "darknet" # "darknet" (libdarknet, GPU) or "opencv" (cv2.dnn, CPU)
+opencv_threads: int = 0 # cv2.dnn worker threads, 0 = OpenCV default
+opencv_input: Tuple[int, int] = (0, 0) # network input size of the opencv detector, (0, 0) = size from the .cfg
 source: str         = "file" # "camera" or "file"
 file_path: str      = "test_video.mp4"
 camera_w: int       = 1920
@@ -14,10 +20,54 @@ thresh: float       = 0.5
 color               = (0, 0, 255)
 mqtt_host: str      = "192.168.1.132"
 mqtt_port: int      = 1883
+mqtt_topic: str     = "/tracker"
+mqtt_device_topics: bool = False # publish to <mqtt_topic>/<device_id>, for aggregator workers sharded by device
+payload_format: str = "json" # "json" or "binary" (payload.py, about 2.5x smaller), the aggregator accepts both
+mqtt_qos: int       = 0
+publish_queue: int  = 100 # frames buffered for MQTT, the oldest are dropped beyond this
+publish_in_flight: int = 100 # messages paho has not sent (QoS 0) or got acknowledged (QoS 1/2), sending waits above this
+publish_max_frames: int = 1 # frames coalesced into one message, 1 = a message per frame as before
+publish_max_bytes: int = 16384 # coalesced message size limit
+publish_max_delay: float = 0.2 # seconds a frame waits for others to join its message
+spool_file: str     = "tracker_spool.bin" # ring file keeping the messages while the broker is unreachable
+spool_size: int     = 64*1024*1024 # bytes of the spool, the oldest messages are overwritten beyond this, 0 = no spool
+spool_replay_rate: float = 50 # spooled messages sent per second after reconnecting, on top of the new messages that wait behind them
+delta_updates: bool = False # between keyframes send only tracks that moved, plus ended tracks
+delta_keyframe_interval: int = 30 # every n-th frame carries all tracks
+delta_min_move_px: float = 3 # movement in pixels that makes a track be sent again, 0 = not used
+delta_min_move_m: float = 0 # movement in metres that makes a track be sent again, 0 = not used
+queue_size: int     = 2
+drop_frames: bool   = True # camera source only: the latest frame wins when inference falls behind
+batch_size: int     = 1 # frames per network_predict_batch call
+batch_max_wait: float = 0.01 # seconds to wait for a batch to fill up
+numpy_nms: bool     = False # class-aware darknet.nms_array instead of do_nms_sort, see benchmark_nms.py
+max_detections: int = 0 # keep at most this many detections per frame after NMS (numpy_nms only), 0 = all
+gps_grid_step: int  = 0 # pixel spacing of the precomputed GPS lookup grid, 0 = project every point
+gps_grid_cache: str = "gps_grid_cache" # directory for the memory-mapped grids
+max_detect_interval: int = 1 # run the detector at most on every n-th frame, tracks are predicted in between, 1 = every frame
+target_fps: float   = 30 # output frame rate the detection interval is adapted to
+dense_tracks: int   = 20 # halve the detection interval from this many live tracks
+motion_gate: bool   = False # skip the detector on frames without motion while no tracks are live
+motion_threshold: int = 25 # grayscale difference to the background that counts as motion
+motion_min_area: float = 0.002 # fraction of the downscaled frame that has to move
+roi: bool           = False # detect only in the bounding rectangle of roi_polygon instead of the whole frame
+roi_polygon: List[Tuple[int, int]] = [] # road area in frame pixels, empty = hull of the reference points
+roi_tiles: Tuple[int, int] = (1, 1) # columns and rows the rectangle is split into, each tile gets the full network input
+roi_overlap: float  = 0.1 # overlap of neighbouring tiles, as a fraction of the tile size
+roi_margin: int     = 64 # pixels added around the polygon's bounding rectangle
+batch_tracker: bool = False # vectorized Kalman tracker (sort.BatchSort), same tracks as Sort
+association_gating: bool = True # score only nearby detection/track pairs, split the assignment into components
+multiprocess: bool  = False # run capture, inference and tracking as separate processes
+ring_slots: int     = 6 # shared-memory frame slots in the multiprocess mode
 
 reference_points = [
     Point(1028, 850, 49.2241922, 16.5798447),
     Point(1770, 716, 49.2241500, 16.5797239),
     Point(527, 356, 49.2233417, 16.5802336),
     Point(297, 354, 49.2234064, 16.5803944),
-]
\ No newline at end of file
+]
+
+# several cameras served by one loaded network, each with its own device id and
+# calibration, e.g. Stream(2, "camera", [...], sensor_id=1); when empty, the single
+# stream described by the values above is used
+streams: List[Stream] = []
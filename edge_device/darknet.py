@@ -12,6 +12,9 @@ from ctypes import *
 import math
 import random
 import os
+from queue import Queue
+
+import numpy as np
 
 
 class BOX(Structure):
@@ -53,6 +56,21 @@ class METADATA(Structure):
                 ("names", POINTER(c_char_p))]
 
 
+# NumPy layout of the DETECTION fields used in post-processing,
+# lets a DETECTION array be read in bulk without touching ctypes per box
+DETECTION_DTYPE = np.dtype({
+    "names": ["x", "y", "w", "h", "best_class_idx", "prob"],
+    "formats": [np.float32, np.float32, np.float32, np.float32, np.int32, np.uintp],
+    "offsets": [DETECTION.bbox.offset + BOX.x.offset,
+                DETECTION.bbox.offset + BOX.y.offset,
+                DETECTION.bbox.offset + BOX.w.offset,
+                DETECTION.bbox.offset + BOX.h.offset,
+                DETECTION.best_class_idx.offset,
+                DETECTION.prob.offset],
+    "itemsize": sizeof(DETECTION),
+})
+
+
 def network_width(net):
     return lib.network_width(net)
 
@@ -185,6 +203,61 @@ def non_max_suppression_fast(detections, overlap_thresh):
         # integer data type
     return [detections[i] for i in pick]
 
+def suppressed_boxes(boxes, overlap_thresh):
+    """
+    Greedy NMS over [x1, y1, x2, y2] boxes sorted by descending score,
+    returns the mask of suppressed boxes
+
+    All pairwise overlaps are computed at once, the sequential part only
+    visits boxes that overlap a lower scored box
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    area = (x2 - x1) * (y2 - y1)
+    w = np.minimum(x2[:, None], x2) - np.maximum(x1[:, None], x1)
+    np.maximum(w, 0, out=w)
+    h = np.minimum(y2[:, None], y2) - np.maximum(y1[:, None], y1)
+    np.maximum(h, 0, out=h)
+    inter = w * h
+    # only a higher scored box may suppress a lower scored one
+    suppress = np.triu(inter > overlap_thresh * (area[:, None] + area - inter), 1)
+
+    removed = np.zeros(len(boxes), dtype=bool)
+    for i in np.flatnonzero(suppress.any(axis=1)).tolist():
+        if not removed[i]:
+            removed |= suppress[i]
+    return removed
+
+
+def nms_array(detections, overlap_thresh=.45, class_aware=True, top_k=None):
+    """
+    Greedy NMS on an (N, 6) [x1, y1, x2, y2, score, class] array
+
+    Works like do_nms_sort when class_aware (boxes only suppress boxes of
+    the same class), returns the kept rows by descending score, at most
+    top_k of them
+    """
+    if len(detections) == 0:
+        return detections
+
+    order = np.argsort(-detections[:, 4], kind="stable")
+    boxes = detections[order, :4].astype(np.float64)
+    removed = np.zeros(len(order), dtype=bool)
+    if class_aware:
+        # stable sort keeps every class block ordered by score
+        classes = detections[order, 5]
+        by_class = np.argsort(classes, kind="stable")
+        bounds = np.flatnonzero(np.diff(classes[by_class])) + 1
+        for group in np.split(by_class, bounds):
+            removed[group] = suppressed_boxes(boxes[group], overlap_thresh)
+    else:
+        removed = suppressed_boxes(boxes, overlap_thresh)
+
+    keep = order[~removed]
+    if top_k is not None:
+        keep = keep[:top_k]
+    return detections[keep]
+
+
 def remove_negatives(detections, class_names, num):
     """
     Remove all classes with 0% confidence within the detection
@@ -214,121 +287,297 @@ def remove_negatives_faster(detections, class_names, num):
     return predictions
 
 
-def detect_image(network, class_names, image, thresh=.5, hier_thresh=.5, nms=.45):
+def detections_as_numpy(detections, num):
+    """
+    View the DETECTION array returned by darknet as a structured
+    NumPy array (no copy, valid until the detections are freed)
+    """
+    if num == 0:
+        return np.empty(0, dtype=DETECTION_DTYPE)
+    buffer = (c_char * (num * sizeof(DETECTION))).from_address(addressof(detections.contents))
+    return np.frombuffer(buffer, dtype=DETECTION_DTYPE)
+
+
+def detection_probs(detections_view, num_classes):
+    """
+    Gather the per-detection prob buffers into one (N, classes) matrix,
+    one memmove per detection
+    """
+    probs = np.empty((len(detections_view), num_classes), dtype=np.float32)
+    row_bytes = num_classes * sizeof(c_float)
+    base = probs.ctypes.data
+    for j, ptr in enumerate(detections_view["prob"].tolist()):
+        memmove(base + j * row_bytes, ptr, row_bytes)
+    return probs
+
+
+def remove_negatives_array(detections, num_classes, num, best_class_only=False):
+    """
+    Vectorized remove_negatives returning a single (N, 6) float32 array
+    of [x1, y1, x2, y2, score, class] rows
+
+    With best_class_only=True it follows remove_negatives_faster and keeps
+    only the best class of every detection
+    """
+    view = detections_as_numpy(detections, num)
+    if best_class_only:
+        view = view[view["best_class_idx"] != -1]
+        probs = detection_probs(view, num_classes)
+        # do_nms_sort zeroes the probabilities of suppressed boxes but keeps their best_class_idx
+        rows = np.flatnonzero(probs[np.arange(len(view)), view["best_class_idx"]] > 0)
+        classes = view["best_class_idx"][rows]
+    else:
+        probs = detection_probs(view, num_classes)
+        rows, classes = np.nonzero(probs > 0)
+
+    x = view["x"][rows]
+    y = view["y"][rows]
+    half_w = view["w"][rows] / 2
+    half_h = view["h"][rows] / 2
+
+    predictions = np.empty((len(rows), 6), dtype=np.float32)
+    predictions[:, 0] = x - half_w
+    predictions[:, 1] = y - half_h
+    predictions[:, 2] = x + half_w
+    predictions[:, 3] = y + half_h
+    predictions[:, 4] = probs[rows, classes]
+    predictions[:, 5] = classes
+    return predictions
+
+
+class ImageSlot:
+    """
+    Preallocated darknet IMAGE together with the uint8 staging arrays
+    cv2 writes the resized BGR and RGB frame into
+    """
+    def __init__(self, width, height):
+        self.image = make_image(width, height, 3)
+        self.resized = np.empty((height, width, 3), dtype=np.uint8)
+        self.rgb = np.empty((height, width, 3), dtype=np.uint8)
+        self._rgb_ptr = self.rgb.ctypes.data
+
+    def upload(self):
+        """
+        Copy the RGB staging array into the IMAGE straight from its buffer
+        """
+        copy_image_from_ptr(self.image, self._rgb_ptr)
+
+
+class ImagePool:
+    """
+    Fixed set of ImageSlots reused between frames instead of calling
+    make_image/free_image for every frame
+    """
+    def __init__(self, width, height, size=2):
+        self.slots = [ImageSlot(width, height) for _ in range(size)]
+        self._free = Queue()
+        for slot in self.slots:
+            self._free.put(slot)
+
+    def acquire(self, block=True, timeout=None):
+        return self._free.get(block, timeout)
+
+    def release(self, slot):
+        self._free.put(slot)
+
+    def free(self):
+        for slot in self.slots:
+            free_image(slot.image)
+        self.slots = []
+
+
+class BatchImage:
+    """
+    Preallocated float32 (batch, 3, h, w) input for network_predict_batch,
+    filled frame by frame from the RGB staging arrays
+    """
+    def __init__(self, width, height, batch_size):
+        self.width = width
+        self.height = height
+        self.batch_size = batch_size
+        self.data = np.zeros((batch_size, 3, height, width), dtype=np.float32)
+        self.image = IMAGE(width, height, 3, self.data.ctypes.data_as(POINTER(c_float)))
+
+    def set(self, index, rgb):
+        np.multiply(rgb.transpose(2, 0, 1), np.float32(1 / 255), out=self.data[index])
+
+
+def copy_image_from_array(image, array):
+    """
+    Upload a C-contiguous (h, w, 3) uint8 RGB array into an IMAGE
+    without the tobytes() copy
+    """
+    copy_image_from_ptr(image, array.ctypes.data)
+
+
+def detect_image(network, class_names, image, thresh=.5, hier_thresh=.5, nms=.45,
+                 as_array=False, best_class_only=False, numpy_nms=False, top_k=None):
     """
         Returns a list with highest confidence class and their bbox
+
+        With as_array=True returns an (N, 6) float32 array of
+        [x1, y1, x2, y2, score, class] rows instead, which can be passed
+        to Sort.update directly, best_class_only=True then keeps a single
+        class per box like remove_negatives_faster
+
+        numpy_nms=True replaces do_nms_sort with nms_array (array output
+        only), top_k then caps the number of returned detections
     """
     pnum = pointer(c_int(0))
     predict_image(network, image)
     detections = get_network_boxes(network, image.w, image.h,
                                    thresh, hier_thresh, None, 0, pnum, 0)
     num = pnum[0]
-    if nms:
+    numpy_nms = numpy_nms and as_array
+    if nms and not numpy_nms:
         do_nms_sort(detections, num, len(class_names), nms)
+    if as_array:
+        predictions = remove_negatives_array(detections, len(class_names), num, best_class_only)
+        free_detections(detections, num)
+        if nms and numpy_nms:
+            predictions = nms_array(predictions, nms, top_k=top_k)
+        return predictions
     predictions = remove_negatives(detections, class_names, num)
     predictions = decode_detection(predictions)
     free_detections(detections, num)
     return sorted(predictions, key=lambda x: x[1])
 
 
-if os.name == "posix":
-    cwd = os.path.dirname(__file__)
-    lib = CDLL(cwd + "/libdarknet.so", RTLD_GLOBAL)
-elif os.name == "nt":
-    cwd = os.path.dirname(__file__)
-    os.environ['PATH'] = cwd + ';' + os.environ['PATH']
-    lib = CDLL("darknet.dll", RTLD_GLOBAL)
-else:
-    print("Unsupported OS")
-    exit
+def detect_batch(network, class_names, batch, count, thresh=.5, hier_thresh=.5, nms=.45,
+                 best_class_only=False, numpy_nms=False, top_k=None):
+    """
+        Runs the network once over the first count images of a BatchImage,
+        the network has to be loaded with the same batch_size
+
+        Returns one (N, 6) float32 detection array per image
+        (see detect_image(..., as_array=True))
+    """
+    batch_detections = network_predict_batch(network, batch.image, batch.batch_size,
+                                             batch.width, batch.height,
+                                             thresh, hier_thresh, None, 0, 0)
+    predictions = []
+    for idx in range(count):
+        num = batch_detections[idx].num
+        detections = batch_detections[idx].dets
+        if nms and not numpy_nms:
+            do_nms_sort(detections, num, len(class_names), nms)
+        dets = remove_negatives_array(detections, len(class_names), num, best_class_only)
+        if nms and numpy_nms:
+            dets = nms_array(dets, nms, top_k=top_k)
+        predictions.append(dets)
+    free_batch_detections(batch_detections, batch.batch_size)
+    return predictions
+
 
-lib.network_width.argtypes = [c_void_p]
-lib.network_width.restype = c_int
-lib.network_height.argtypes = [c_void_p]
-lib.network_height.restype = c_int
+# the library is only required by the darknet detector backend,
+# detectors.OpenCVDetector runs without it
+lib = None
+lib_error = None # why the library could not be loaded, e.g. a missing CUDA runtime
+try:
+    if os.name == "posix":
+        cwd = os.path.dirname(__file__)
+        lib = CDLL(cwd + "/libdarknet.so", RTLD_GLOBAL)
+    elif os.name == "nt":
+        cwd = os.path.dirname(__file__)
+        os.environ['PATH'] = cwd + ';' + os.environ['PATH']
+        lib = CDLL("darknet.dll", RTLD_GLOBAL)
+    else:
+        print("Unsupported OS")
+except OSError as e:
+    lib = None
+    lib_error = e
 
-copy_image_from_bytes = lib.copy_image_from_bytes
-copy_image_from_bytes.argtypes = [IMAGE,c_char_p]
+if lib is not None:
+    lib.network_width.argtypes = [c_void_p]
+    lib.network_width.restype = c_int
+    lib.network_height.argtypes = [c_void_p]
+    lib.network_height.restype = c_int
 
-predict = lib.network_predict_ptr
-predict.argtypes = [c_void_p, POINTER(c_float)]
-predict.restype = POINTER(c_float)
+    copy_image_from_bytes = lib.copy_image_from_bytes
+    copy_image_from_bytes.argtypes = [IMAGE,c_char_p]
 
-set_gpu = lib.cuda_set_device
-init_cpu = lib.init_cpu
+    copy_image_from_ptr = lib["copy_image_from_bytes"]
+    copy_image_from_ptr.argtypes = [IMAGE, c_void_p]
 
-make_image = lib.make_image
-make_image.argtypes = [c_int, c_int, c_int]
-make_image.restype = IMAGE
+    predict = lib.network_predict_ptr
+    predict.argtypes = [c_void_p, POINTER(c_float)]
+    predict.restype = POINTER(c_float)
 
-get_network_boxes = lib.get_network_boxes
-get_network_boxes.argtypes = [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(c_int), c_int]
-get_network_boxes.restype = POINTER(DETECTION)
+    set_gpu = lib.cuda_set_device
+    init_cpu = lib.init_cpu
 
-make_network_boxes = lib.make_network_boxes
-make_network_boxes.argtypes = [c_void_p]
-make_network_boxes.restype = POINTER(DETECTION)
+    make_image = lib.make_image
+    make_image.argtypes = [c_int, c_int, c_int]
+    make_image.restype = IMAGE
 
-free_detections = lib.free_detections
-free_detections.argtypes = [POINTER(DETECTION), c_int]
+    get_network_boxes = lib.get_network_boxes
+    get_network_boxes.argtypes = [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(c_int), c_int]
+    get_network_boxes.restype = POINTER(DETECTION)
 
-free_batch_detections = lib.free_batch_detections
-free_batch_detections.argtypes = [POINTER(DETNUMPAIR), c_int]
+    make_network_boxes = lib.make_network_boxes
+    make_network_boxes.argtypes = [c_void_p]
+    make_network_boxes.restype = POINTER(DETECTION)
 
-free_ptrs = lib.free_ptrs
-free_ptrs.argtypes = [POINTER(c_void_p), c_int]
+    free_detections = lib.free_detections
+    free_detections.argtypes = [POINTER(DETECTION), c_int]
 
-network_predict = lib.network_predict_ptr
-network_predict.argtypes = [c_void_p, POINTER(c_float)]
+    free_batch_detections = lib.free_batch_detections
+    free_batch_detections.argtypes = [POINTER(DETNUMPAIR), c_int]
 
-reset_rnn = lib.reset_rnn
-reset_rnn.argtypes = [c_void_p]
+    free_ptrs = lib.free_ptrs
+    free_ptrs.argtypes = [POINTER(c_void_p), c_int]
 
-load_net = lib.load_network
-load_net.argtypes = [c_char_p, c_char_p, c_int]
-load_net.restype = c_void_p
+    network_predict = lib.network_predict_ptr
+    network_predict.argtypes = [c_void_p, POINTER(c_float)]
 
-load_net_custom = lib.load_network_custom
-load_net_custom.argtypes = [c_char_p, c_char_p, c_int, c_int]
-load_net_custom.restype = c_void_p
+    reset_rnn = lib.reset_rnn
+    reset_rnn.argtypes = [c_void_p]
 
-free_network_ptr = lib.free_network_ptr
-free_network_ptr.argtypes = [c_void_p]
-free_network_ptr.restype = c_void_p
+    load_net = lib.load_network
+    load_net.argtypes = [c_char_p, c_char_p, c_int]
+    load_net.restype = c_void_p
 
-do_nms_obj = lib.do_nms_obj
-do_nms_obj.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
+    load_net_custom = lib.load_network_custom
+    load_net_custom.argtypes = [c_char_p, c_char_p, c_int, c_int]
+    load_net_custom.restype = c_void_p
 
-do_nms_sort = lib.do_nms_sort
-do_nms_sort.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
+    free_network_ptr = lib.free_network_ptr
+    free_network_ptr.argtypes = [c_void_p]
+    free_network_ptr.restype = c_void_p
 
-free_image = lib.free_image
-free_image.argtypes = [IMAGE]
+    do_nms_obj = lib.do_nms_obj
+    do_nms_obj.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
 
-letterbox_image = lib.letterbox_image
-letterbox_image.argtypes = [IMAGE, c_int, c_int]
-letterbox_image.restype = IMAGE
+    do_nms_sort = lib.do_nms_sort
+    do_nms_sort.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
 
-load_meta = lib.get_metadata
-lib.get_metadata.argtypes = [c_char_p]
-lib.get_metadata.restype = METADATA
+    free_image = lib.free_image
+    free_image.argtypes = [IMAGE]
 
-load_image = lib.load_image_color
-load_image.argtypes = [c_char_p, c_int, c_int]
-load_image.restype = IMAGE
+    letterbox_image = lib.letterbox_image
+    letterbox_image.argtypes = [IMAGE, c_int, c_int]
+    letterbox_image.restype = IMAGE
 
-rgbgr_image = lib.rgbgr_image
-rgbgr_image.argtypes = [IMAGE]
+    load_meta = lib.get_metadata
+    lib.get_metadata.argtypes = [c_char_p]
+    lib.get_metadata.restype = METADATA
 
-predict_image = lib.network_predict_image
-predict_image.argtypes = [c_void_p, IMAGE]
-predict_image.restype = POINTER(c_float)
+    load_image = lib.load_image_color
+    load_image.argtypes = [c_char_p, c_int, c_int]
+    load_image.restype = IMAGE
 
-predict_image_letterbox = lib.network_predict_image_letterbox
-predict_image_letterbox.argtypes = [c_void_p, IMAGE]
-predict_image_letterbox.restype = POINTER(c_float)
+    rgbgr_image = lib.rgbgr_image
+    rgbgr_image.argtypes = [IMAGE]
+
+    predict_image = lib.network_predict_image
+    predict_image.argtypes = [c_void_p, IMAGE]
+    predict_image.restype = POINTER(c_float)
+
+    predict_image_letterbox = lib.network_predict_image_letterbox
+    predict_image_letterbox.argtypes = [c_void_p, IMAGE]
+    predict_image_letterbox.restype = POINTER(c_float)
 
-network_predict_batch = lib.network_predict_batch
-network_predict_batch.argtypes = [c_void_p, IMAGE, c_int, c_int, c_int,
-                                   c_float, c_float, POINTER(c_int), c_int, c_int]
-network_predict_batch.restype = POINTER(DETNUMPAIR)
+    network_predict_batch = lib.network_predict_batch
+    network_predict_batch.argtypes = [c_void_p, IMAGE, c_int, c_int, c_int,
+                                       c_float, c_float, POINTER(c_int), c_int, c_int]
+    network_predict_batch.restype = POINTER(DETNUMPAIR)
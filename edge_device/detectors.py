@@ -0,0 +1,205 @@
+from abc import ABC, abstractmethod
+import os
+from queue import Queue
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import darknet
+
+
+class Detector(ABC):
+    """
+    Common interface of the inference backends. A detector hands out a pool
+    of image slots sized for its input (net_shape), the pipeline resizes
+    frames into slot.resized / slot.rgb and detect() turns a list of slots
+    into one (N, 6) float32 [x1, y1, x2, y2, score, class] array per slot,
+    in network input coordinates.
+    """
+    net_shape: Tuple[int, int] = (0, 0)
+    class_names: List[str] = []
+
+    @abstractmethod
+    def pool(self, size: int):
+        ...
+
+    @abstractmethod
+    def detect(self, slots: List) -> List[np.ndarray]:
+        ...
+
+
+class DarknetDetector(Detector):
+    """
+    libdarknet backend, runs the network on the GPU of the Jetsons
+    """
+    def __init__(self, config_file: str, data_file: str, weights: str, batch_size: int = 1, thresh: float = .5,
+                 nms: float = .45, numpy_nms: bool = False, top_k: Optional[int] = None) -> None:
+        if darknet.lib is None:
+            print(f"libdarknet is not available ({darknet.lib_error or 'unsupported OS'}), use the opencv detector.")
+            exit(1)
+        self.net, self.class_names, _ = darknet.load_network(
+            config_file=config_file,
+            data_file=data_file,
+            weights=weights,
+            batch_size=batch_size
+        )
+        self.net_shape = (darknet.network_width(self.net), darknet.network_height(self.net))
+        self.batch_size = batch_size
+        self.thresh = thresh
+        self.nms = nms
+        self.numpy_nms = numpy_nms
+        self.top_k = top_k
+        self.batch = darknet.BatchImage(*self.net_shape, batch_size) if batch_size > 1 else None
+
+    def pool(self, size: int):
+        return darknet.ImagePool(*self.net_shape, size=size)
+
+    def detect(self, slots: List) -> List[np.ndarray]:
+        if self.batch is None:
+            # single images are read from slot.image, uploaded by preprocess
+            return [darknet.detect_image(self.net, self.class_names, slot.image, thresh=self.thresh, nms=self.nms,
+                                         as_array=True, numpy_nms=self.numpy_nms, top_k=self.top_k)
+                    for slot in slots]
+
+        detections: List[np.ndarray] = []
+        for start in range(0, len(slots), self.batch_size):
+            chunk = slots[start:start + self.batch_size]
+            for i, slot in enumerate(chunk):
+                self.batch.set(i, slot.rgb)
+            detections += darknet.detect_batch(self.net, self.class_names, self.batch, len(chunk), thresh=self.thresh,
+                                               nms=self.nms, numpy_nms=self.numpy_nms, top_k=self.top_k)
+        return detections
+
+
+class ArraySlot:
+    """
+    ImageSlot without a darknet IMAGE, the network input is built from rgb
+    """
+    def __init__(self, width: int, height: int) -> None:
+        self.image = None
+        self.resized = np.empty((height, width, 3), dtype=np.uint8)
+        self.rgb = np.empty((height, width, 3), dtype=np.uint8)
+
+    def upload(self) -> None:
+        pass
+
+
+class ArrayPool:
+    """
+    darknet.ImagePool of ArraySlots
+    """
+    def __init__(self, width: int, height: int, size: int = 2) -> None:
+        self.slots = [ArraySlot(width, height) for _ in range(size)]
+        self._free: Queue = Queue()
+        for slot in self.slots:
+            self._free.put(slot)
+
+    def acquire(self, block: bool = True, timeout: Optional[float] = None) -> ArraySlot:
+        return self._free.get(block, timeout)
+
+    def release(self, slot: ArraySlot) -> None:
+        self._free.put(slot)
+
+    def free(self) -> None:
+        self.slots = []
+
+
+def read_class_names(data_file: str) -> List[str]:
+    """
+    Class names from the names file referenced by a darknet .data file
+    """
+    options = {}
+    with open(data_file) as f:
+        for line in f:
+            line = line.split("#")[0]
+            if "=" in line:
+                key, value = line.split("=", 1)
+                options[key.strip()] = value.strip()
+    names_file = options["names"]
+    if not os.path.isabs(names_file) and not os.path.exists(names_file):
+        names_file = os.path.join(os.path.dirname(data_file), names_file)
+    with open(names_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class OpenCVDetector(Detector):
+    """
+    CPU backend running the same .cfg and weights through cv2.dnn, for
+    machines without libdarknet or a GPU. input_size overrides the
+    network input from the .cfg, (0, 0) keeps it.
+    """
+    def __init__(self, config_file: str, data_file: str, weights: str, batch_size: int = 1, thresh: float = .5,
+                 nms: float = .45, top_k: Optional[int] = None, input_size: Tuple[int, int] = (0, 0),
+                 threads: int = 0, best_class_only: bool = False) -> None:
+        if not hasattr(cv2.dnn, "readNetFromDarknet"):
+            print("This OpenCV build cannot read darknet networks (removed in OpenCV 5), use OpenCV 4.")
+            exit(1)
+        if threads:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromDarknet(config_file, weights)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.out_names = self.net.getUnconnectedOutLayersNames()
+        self.class_names = read_class_names(data_file)
+
+        self.net_shape = tuple(input_size) if all(input_size) else OpenCVDetector.cfg_input_size(config_file)
+        net_w, net_h = self.net_shape
+        self.batch_size = batch_size
+        self.thresh = thresh
+        self.nms = nms
+        self.top_k = top_k
+        self.best_class_only = best_class_only
+        self.blob = np.zeros((batch_size, 3, net_h, net_w), dtype=np.float32)
+
+    @staticmethod
+    def cfg_input_size(config_file: str) -> Tuple[int, int]:
+        size = {}
+        with open(config_file) as f:
+            for line in f:
+                key, _, value = line.partition("=")
+                if key.strip() in ("width", "height") and key.strip() not in size:
+                    size[key.strip()] = int(value)
+        return (size["width"], size["height"])
+
+    def pool(self, size: int) -> ArrayPool:
+        return ArrayPool(*self.net_shape, size=size)
+
+    def detect(self, slots: List) -> List[np.ndarray]:
+        detections: List[np.ndarray] = []
+        for start in range(0, len(slots), self.batch_size):
+            chunk = slots[start:start + self.batch_size]
+            for i, slot in enumerate(chunk):
+                np.multiply(slot.rgb.transpose(2, 0, 1), np.float32(1 / 255), out=self.blob[i])
+            self.net.setInput(self.blob[:len(chunk)])
+            outs = self.net.forward(self.out_names)
+            # one (boxes, 5 + classes) matrix per yolo layer, with a leading batch axis for more than one image
+            outs = [out.reshape(len(chunk), -1, out.shape[-1]) for out in outs]
+            for i in range(len(chunk)):
+                detections.append(self.decode(np.concatenate([out[i] for out in outs])))
+        return detections
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        """
+        [cx, cy, w, h, objectness, class probabilities...] rows relative to
+        the input size to the darknet.detect_image array format
+        """
+        net_w, net_h = self.net_shape
+        probs = rows[:, 5:]
+        if self.best_class_only:
+            idx = np.flatnonzero(probs.max(axis=1) > self.thresh)
+            classes = probs[idx].argmax(axis=1)
+        else:
+            idx, classes = np.nonzero(probs > self.thresh)
+
+        boxes = rows[idx]
+        predictions = np.empty((len(idx), 6), dtype=np.float32)
+        predictions[:, 0] = (boxes[:, 0] - boxes[:, 2] / 2) * net_w
+        predictions[:, 1] = (boxes[:, 1] - boxes[:, 3] / 2) * net_h
+        predictions[:, 2] = (boxes[:, 0] + boxes[:, 2] / 2) * net_w
+        predictions[:, 3] = (boxes[:, 1] + boxes[:, 3] / 2) * net_h
+        predictions[:, 4] = probs[idx, classes]
+        predictions[:, 5] = classes
+        if self.nms:
+            predictions = darknet.nms_array(predictions, self.nms, top_k=self.top_k)
+        return predictions
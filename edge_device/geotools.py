@@ -1,6 +1,8 @@
 from __future__ import annotations
+import hashlib
 import math
-from typing import List, Tuple
+import os
+from typing import List, Optional, Tuple
 
 import numpy as np
 import cv2
@@ -34,6 +36,37 @@ class Point:
         return [self.x, self.y, self.lat, self.lon]
 
 
+class GpsGrid:
+    """
+    (lat, lon) precomputed for every step-th pixel of the frame, other pixels
+    are interpolated bilinearly from the four surrounding nodes.
+    """
+    def __init__(self, grid: np.ndarray, step: int) -> None:
+        self.grid = grid
+        self.step = step
+
+    @staticmethod
+    def nodes(frame_shape: Tuple[int, int], step: int) -> Tuple[np.ndarray, np.ndarray]:
+        frame_w, frame_h = frame_shape
+        # one node past the last pixel so every pixel lies between two nodes
+        xs = np.arange(0, frame_w + step, step, dtype=np.float64)
+        ys = np.arange(0, frame_h + step, step, dtype=np.float64)
+        return xs, ys
+
+    def lookup(self, points: np.ndarray) -> np.ndarray:
+        rows, cols, _ = self.grid.shape
+        gx = np.asarray(points[:, 0], dtype=np.float64) / self.step
+        gy = np.asarray(points[:, 1], dtype=np.float64) / self.step
+        ix = np.clip(np.floor(gx).astype(int), 0, cols - 2)
+        iy = np.clip(np.floor(gy).astype(int), 0, rows - 2)
+        fx = (gx - ix)[:, None]
+        fy = (gy - iy)[:, None]
+
+        top = self.grid[iy, ix] * (1 - fx) + self.grid[iy, ix + 1] * fx
+        bottom = self.grid[iy + 1, ix] * (1 - fx) + self.grid[iy + 1, ix + 1] * fx
+        return top * (1 - fy) + bottom * fy
+
+
 class CoordinatesConverter:
     def __init__(self, ref_points: List[Point]) -> None:
         self.ref_points = ref_points
@@ -41,6 +74,32 @@ class CoordinatesConverter:
             np.float32([(p.x, p.y) for p in self.ref_points]),  # type: ignore
             np.float32([(p.lat, p.lon) for p in self.ref_points]),  # type: ignore
         )
+        self.grid: Optional[GpsGrid] = None
+
+    def gridKey(self, frame_shape: Tuple[int, int], step: int) -> str:
+        h = hashlib.sha1()
+        for p in self.ref_points:
+            h.update(repr(p.toList()).encode())
+        h.update(repr((tuple(frame_shape), step)).encode())
+        return h.hexdigest()
+
+    def enableGrid(self, frame_shape: Tuple[int, int], step: int, cache_dir: str) -> None:
+        """
+        Switches pixelsToGps to a lookup grid, memory-mapped from cache_dir and
+        only computed when no grid for these reference points, frame size and step exists yet.
+        """
+        path = os.path.join(cache_dir, f"gps_grid_{self.gridKey(frame_shape, step)}.npy")
+        if not os.path.exists(path):
+            xs, ys = GpsGrid.nodes(frame_shape, step)
+            gx, gy = np.meshgrid(xs, ys)
+            grid = self.projectPixels(np.stack((gx.ravel(), gy.ravel()), axis=1))
+            os.makedirs(cache_dir, exist_ok=True)
+            # write under a temporary name so other processes never map a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, grid.reshape(len(ys), len(xs), 2))
+            os.replace(tmp_path, path)
+        self.grid = GpsGrid(np.load(path, mmap_mode="r"), step)
 
     def pixelToGps(self, x: int, y: int) -> Tuple[float, float]:
         pixel_coords = np.array([x, y, 1], dtype=np.float32)
@@ -48,3 +107,17 @@ class CoordinatesConverter:
         gps_coords = coords[:2] / coords[2]
 
         return (gps_coords[0], gps_coords[1])
+
+    def pixelsToGps(self, points: np.ndarray) -> np.ndarray:
+        """
+        Converts an (N, 2) array of pixel coordinates to an (N, 2) array of (lat, lon) in one call.
+        """
+        if len(points) == 0:
+            return np.empty((0, 2))
+        if self.grid is not None:
+            return self.grid.lookup(points)
+        return self.projectPixels(points)
+
+    def projectPixels(self, points: np.ndarray) -> np.ndarray:
+        pixel_coords = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(pixel_coords, self.trans_matrix).reshape(-1, 2)
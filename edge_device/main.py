@@ -1,26 +1,23 @@
-import json
-from queue import Queue
+from queue import Empty, Queue
 import threading as mt
 import time
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
 import paho.mqtt.client as mqtt
 
 import config
-import darknet
+from detectors import DarknetDetector, OpenCVDetector
 from geotools import Point, CoordinatesConverter
-from sort import Sort
-
-
-def track_vehicles(tracker, detections):
-    dets = np.empty((0, 5))
-    for _, confidence, bbox in detections:
-        x1, y1, x2, y2 = darknet.bbox2points(bbox)
-        dets = np.append(dets, [[x1, y1, x2, y2, float(confidence)/100]], axis=0)
-    tracks = tracker.update(dets)
-    return tracks
+import payload
+from pipeline import STOP, Frame, RoundRobin, collect_batch, put_latest
+from publisher import DeltaFilter, InFlight, Publisher
+from roi import Roi
+from scheduling import DetectionInterval, MotionGate
+from sort import BatchSort, Sort
+from spool import Spool
+from streams import Stream
 
 
 def convert_tracks_to_gps(converter, tracks, net_shape, frame_shape):
@@ -39,16 +36,38 @@ def convert_tracks_to_gps(converter, tracks, net_shape, frame_shape):
     return tracks_gps
 
 
+def convert_tracks_to_gps_arrays(converter, tracks, net_shape, frame_shape):
+    """
+    Columnar convert_tracks_to_gps, returns the track ids, an (N, 2) int array
+    of the bottom-centre pixels and an (N, 2) array of their (lat, lon)
+    """
+    net_w, net_h = net_shape
+    frame_w, frame_h = frame_shape
+    boxes = tracks[:, :4].astype(float)
+    xy = np.empty((len(tracks), 2), dtype=int)
+    xy[:, 0] = ((boxes[:, 0] + boxes[:, 2])/2/net_w)*frame_w
+    xy[:, 1] = (boxes[:, 3]/net_h)*frame_h
+    return tracks[:, 4], xy, converter.pixelsToGps(xy)
+
+
+def preprocess(frame, slot, net_shape, upload: bool = True):
+    cv2.resize(frame, net_shape, dst=slot.resized, interpolation=cv2.INTER_LINEAR)
+    cv2.cvtColor(slot.resized, cv2.COLOR_BGR2RGB, dst=slot.rgb)
+    # batched inference reads slot.rgb into its own input buffer
+    if upload:
+        slot.upload()
+
+
 def draw_crosshair(img, x: int, y: int, color: Tuple[int, int, int] = (0, 0, 255), width: int = 1) -> None:
     cv2.line(img, (x - 10, y), (x + 10, y), color, width)
     cv2.line(img, (x, y - 10), (x, y + 10), color, width)
     cv2.circle(img, (x, y), 8, color, width)
 
 
-def draw(frame, tracks, net_shape, frame_shape):
+def draw(frame, tracks, net_shape, frame_shape, reference_points):
     net_w, net_h = net_shape
     frame_w, frame_h = frame_shape
-    for p in config.reference_points:
+    for p in reference_points:
         draw_crosshair(frame, p.x, p.y)
         cv2.putText(frame, f"({p.x}, {p.y})", (p.x-45, p.y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
 
@@ -65,100 +84,387 @@ def draw(frame, tracks, net_shape, frame_shape):
         draw_crosshair(frame, x, y, config.color, 2)
 
 
-def send_data(tracks_q: Queue):
+def show(frame: Frame, stream: Stream, net_shape) -> bool:
+    draw(frame.image, frame.tracks, net_shape, frame.shape(), stream.reference_points)
+    if stream.roi is not None:
+        cv2.polylines(frame.image, [stream.roi.polygon], True, (0, 255, 0), 1)
+    image = cv2.resize(frame.image, (1280, 720), interpolation=cv2.INTER_LINEAR)
+    cv2.namedWindow(stream.name(), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
+    cv2.imshow(stream.name(), image)
+
+    return cv2.waitKey(1) != ord('q')
+
+
+def queue_tracks(publisher: Publisher, device_id: int, capture_time: float, tracks_gps, ended, delta=None):
+    ids, xy, latlon = tracks_gps
+    is_delta = False
+    if delta is not None:
+        ids, xy, latlon, is_delta = delta.filter(ids, xy, latlon, ended)
+    publisher.put([device_id, capture_time, (ids, xy, latlon), ended, is_delta])
+
+
+def encode_tracks(item):
+    device_id, cap_time, (ids, xy, latlon), ended, delta = item
+    if not len(ids) and not len(ended):
+        return None
+    return payload.encode(config.payload_format, device_id, cap_time, ids, xy, latlon, ended, delta)
+
+
+def topic(device_id: Optional[int]) -> str:
+    if config.mqtt_device_topics:
+        return f"{config.mqtt_topic}/{device_id}"
+    return config.mqtt_topic
+
+
+def publish(client, in_flight: InFlight, topic: str, data: bytes) -> bool:
+    # waits while paho holds too many unsent messages, the publisher drops frames meanwhile
+    in_flight.wait(client.is_connected)
+    info = client.publish(topic, data, qos=config.mqtt_qos)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        return False
+    in_flight.add(info, config.mqtt_qos)
+    return True
+
+
+def replay_spool(client, in_flight: InFlight, spool: Spool, live: mt.Semaphore, stop: mt.Event):
+    """
+    Send the spooled messages, oldest first, at spool_replay_rate messages
+    per second once the broker is reachable again, plus one for every live
+    message queued behind them (released in live), so the spool shrinks
+    at spool_replay_rate whatever the live rate is
+    """
+    while not stop.is_set():
+        record = spool.peek() if client.is_connected() else None
+        if record is None:
+            stop.wait(0.5)
+            continue
+        seq, data = record
+        if publish(client, in_flight, topic(payload.device_id(data)), data):
+            spool.pop(seq)
+            if live.acquire(blocking=False):
+                continue
+        stop.wait(1/config.spool_replay_rate)
+
+
+def send_data(publisher: Publisher):
     client = mqtt.Client()
-    client.connect(config.mqtt_host, config.mqtt_port)
+    # QoS 1/2 messages waiting for the broker are bounded like the publisher itself
+    client.max_queued_messages_set(config.publish_queue)
+    # QoS 0 messages are not bounded by paho, the messages not sent yet are counted here
+    in_flight = InFlight(config.publish_in_flight)
+    client.on_disconnect = lambda client, userdata, rc: in_flight.disconnected()
+    # connect in the background, paho keeps reconnecting while the broker is down
+    client.connect_async(config.mqtt_host, config.mqtt_port)
     client.loop_start()
 
+    spool = None
+    if config.spool_size:
+        spool = Spool(config.spool_file, config.spool_size)
+        stop = mt.Event()
+        live = mt.Semaphore(0)
+        replay = mt.Thread(target=replay_spool, args=(client, in_flight, spool, live, stop))
+        replay.start()
+
     while True:
-        cap_time, tracks = tracks_q.get()
-        if not tracks: continue
+        messages = publisher.next_batch(encode_tracks)
+        if not messages:
+            break
+        data = messages[0] if len(messages) == 1 else payload.encode_batch(messages)
+        sent = False
+        # while older messages wait in the spool new ones queue behind them, so the
+        # broker gets everything in the order it was captured
+        if spool is None or (client.is_connected() and len(spool) == 0):
+            sent = publish(client, in_flight, topic(publisher.batch_key), data)
+        if not sent and spool is not None:
+            spool.append(data)
+            if client.is_connected():
+                # spooled only to keep the order, replay sends it on top of its rate
+                live.release()
+        publisher.sent(len(messages), sent)
+
+    client.loop_stop()
+    if spool is not None:
+        stop.set()
+        replay.join()
+        if config.debug:
+            print(f"Spooled messages: {len(spool)}, dropped from the spool: {spool.dropped}")
+        spool.close()
+    if config.debug:
+        print(f"Published frames: {publisher.frames}, messages: {publisher.messages}, failed: {publisher.failed}, "
+              f"dropped frames: {publisher.dropped}, max queue depth: {publisher.max_depth}, "
+              f"max in flight: {in_flight.max_count}")
 
-        payload = {
-            "device_id": config.device_id,
-            "capture_time": cap_time,
-            "tracks": {},
-        }
-        for id, point in tracks:
-            payload["tracks"][str(id)] = point.toList()
-        client.publish("/tracker",  json.dumps(payload))
 
+def make_publisher() -> Publisher:
+    # with a topic per device a message only coalesces frames of one device
+    key = (lambda item: item[0]) if config.mqtt_device_topics else None
+    return Publisher(config.publish_queue, config.publish_max_frames, config.publish_max_bytes, config.publish_max_delay, key)
 
-def main():
-    net, classes, _ = darknet.load_network(
-        config_file=config.config_file,
-        data_file=config.data_file,
-        weights=config.weights,
-        batch_size=1
-    )
-    net_w = darknet.network_width(net)
-    net_h = darknet.network_height(net)
-
-    coord_converter: CoordinatesConverter = CoordinatesConverter(config.reference_points)
-    tracker: Sort = Sort(max_age=7)
-
-    tracks_q: Queue = Queue()
-    mt.Thread(target=send_data, args=(tracks_q, )).start()
-
-    if config.source == "camera":
-        pipeline: str = "nvarguscamerasrc sensor-id=0 !"\
-            f"video/x-raw(memory:NVMM), width=(int){config.camera_w}, height=(int){config.camera_h}, framerate=(fraction)30/1 !"\
+
+def make_delta() -> DeltaFilter:
+    return DeltaFilter(config.delta_keyframe_interval, config.delta_min_move_px, config.delta_min_move_m)
+
+
+def make_detector(batch_size: int):
+    if config.detector == "darknet":
+        return DarknetDetector(config.config_file, config.data_file, config.weights, batch_size=batch_size,
+                               thresh=config.thresh, numpy_nms=config.numpy_nms, top_k=config.max_detections or None)
+    elif config.detector == "opencv":
+        return OpenCVDetector(config.config_file, config.data_file, config.weights, batch_size=batch_size,
+                              thresh=config.thresh, top_k=config.max_detections or None,
+                              input_size=config.opencv_input, threads=config.opencv_threads)
+    else:
+        print("Invalid detector.")
+        exit(1)
+
+
+def make_tracker():
+    if config.batch_tracker:
+        return BatchSort(max_age=7, gating=config.association_gating)
+    return Sort(max_age=7, gating=config.association_gating)
+
+
+def configured_streams() -> List[Stream]:
+    if config.streams:
+        return config.streams
+    return [Stream(
+        config.device_id,
+        config.source,
+        config.reference_points,
+        file_path=config.file_path,
+        camera_w=config.camera_w,
+        camera_h=config.camera_h,
+        roi_polygon=config.roi_polygon,
+    )]
+
+
+def roi_polygon(stream: Stream) -> List[Tuple[int, int]]:
+    if stream.roi_polygon:
+        return stream.roi_polygon
+    # the calibration points span the road the GPS conversion is valid for
+    points = np.array([p.pixelCoorinates() for p in stream.reference_points], dtype=np.int32)
+    return [tuple(p) for p in cv2.convexHull(points).reshape(-1, 2).tolist()]
+
+
+def open_capture(stream: Stream):
+    if stream.source == "camera":
+        pipeline: str = f"nvarguscamerasrc sensor-id={stream.sensor_id} !"\
+            f"video/x-raw(memory:NVMM), width=(int){stream.camera_w}, height=(int){stream.camera_h}, framerate=(fraction)30/1 !"\
             "nvvidconv flip-method=0 !"\
-            f"video/x-raw, width=(int){config.camera_w}, height=(int){config.camera_h}, format=(string)BGRx !"\
+            f"video/x-raw, width=(int){stream.camera_w}, height=(int){stream.camera_h}, format=(string)BGRx !"\
             "videoconvert ! video/x-raw, format=(string)BGR ! appsink"
-        cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
-    elif config.source == "file":
-        cap = cv2.VideoCapture(config.file_path)
+        return cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+    elif stream.source == "file":
+        return cv2.VideoCapture(stream.file_path)
     else:
-        print("Invalid source.")
-        exit(1)
+        # called from the capture threads, the caller ends the stream instead of exiting
+        print(f"Invalid source of device {stream.device_id}.")
+        return None
 
-    if config.debug:
-        processing_times = []
-        frames = 1
 
+def frame_time(cap, stream: Stream, capture_time: float, read_time: float) -> float:
+    if stream.source == "file":
+        return capture_time + 1/cap.get(cv2.CAP_PROP_FPS)
+    return read_time
+
+
+def capture(stream: Stream, frames_q: Queue, stop: mt.Event):
+    # a live camera must never build up a backlog, a file is processed frame by frame
+    drop_frames = config.drop_frames and stream.source == "camera"
+    dropped = 0
+
+    cap = open_capture(stream)
+    if cap is None or not cap.isOpened():
+        if cap is not None:
+            print(f"Cannot open the source of device {stream.device_id}.")
+        # the other stages end once every stream has sent STOP
+        frames_q.put(STOP)
+        return
     capture_time = time.time()
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if config.debug:
-            start_time = time.time()
-        if config.source == "file":
-            capture_time += 1/cap.get(cv2.CAP_PROP_FPS)
-        else:
-            capture_time = time.time()
+    while cap.isOpened() and not stop.is_set():
+        ret, image = cap.read()
+        read_time = time.time()
+        capture_time = frame_time(cap, stream, capture_time, read_time)
         if not ret:
             break
 
-        frame_h, frame_w, _ = frame.shape
+        frame = Frame(capture_time, image)
+        frame.stream = stream
+        frame.read_time = read_time
+        if drop_frames:
+            dropped += put_latest(frames_q, frame)
+        else:
+            frames_q.put(frame)
 
-        img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = cv2.resize(img, (net_w, net_h), interpolation=cv2.INTER_LINEAR)
-        img_darknet = darknet.make_image(net_w, net_h, 3)
-        darknet.copy_image_from_bytes(img_darknet, img.tobytes())
-        detections = darknet.detect_image(net, classes, img_darknet, thresh=config.thresh)
-        darknet.free_image(img_darknet)
+    cap.release()
+    frames_q.put(STOP)
+    if config.debug and drop_frames:
+        print(f"Device {stream.device_id} dropped frames: {dropped}")
 
-        tracks = track_vehicles(tracker, detections)
-        tracks_gps = convert_tracks_to_gps(coord_converter, tracks, (net_w, net_h), (frame_w, frame_h))
-        tracks_q.put([capture_time, tracks_gps])
-        
-        if config.display:
-            draw(frame, tracks, (net_w, net_h), (frame_w, frame_h))
-            image = cv2.resize(frame, (1280, 720), interpolation=cv2.INTER_LINEAR)
-            cv2.namedWindow("Vehicle tracking", cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
-            cv2.imshow("Vehicle tracking", image)
-            
-            if cv2.waitKey(1) == ord('q'):
+
+def preprocessing(frames: RoundRobin, images_q: Queue, image_pool, net_shape):
+    while True:
+        frame = frames.get()
+        if frame is STOP:
+            break
+        stream = frame.stream
+        detect = True
+        if stream.motion is not None:
+            detect = stream.motion.should_detect(frame.image, len(stream.tracker.trackers))
+        if detect and stream.scheduler is not None:
+            detect = stream.scheduler.should_detect()
+        if not detect:
+            images_q.put(frame)
+            continue
+        if config.roi and stream.roi is None:
+            stream.roi = Roi(roi_polygon(stream), frame.shape(), config.roi_tiles, config.roi_overlap, config.roi_margin)
+        crops = [frame.image] if stream.roi is None else stream.roi.crops(frame.image)
+        for crop in crops:
+            slot = image_pool.acquire()
+            preprocess(crop, slot, net_shape, upload=config.batch_size == 1)
+            frame.slots.append(slot)
+        images_q.put(frame)
+    images_q.put(STOP)
+
+
+def inference(images_q: Queue, detections_q: Queue, detector, image_pool):
+    stopped = False
+    while not stopped:
+        if config.batch_size == 1:
+            frame = images_q.get()
+            if frame is STOP:
+                break
+            frames = [frame]
+        else:
+            frames, stopped = collect_batch(images_q, config.batch_size, config.batch_max_wait)
+            if not frames:
                 break
-        
+
+        # frames skipped by the detection interval pass through without slots,
+        # an ROI frame has one slot per tile
+        pending = [frame for frame in frames if frame.slots]
+        if pending:
+            start_time = time.time()
+            detections = detector.detect([slot for frame in pending for slot in frame.slots])
+            inference_time = (time.time() - start_time)/len(pending)
+
+            for frame in pending:
+                count = len(frame.slots)
+                dets, detections = detections[:count], detections[count:]
+                roi = frame.stream.roi
+                frame.detections = dets[0] if roi is None else roi.merge(dets, detector.net_shape)
+                for slot in frame.slots:
+                    image_pool.release(slot)
+                frame.slots = []
+                if frame.stream.scheduler is not None:
+                    frame.stream.scheduler.record_inference(inference_time)
+
+        for frame in frames:
+            detections_q.put(frame)
+    detections_q.put(STOP)
+
+
+def tracking(detections_q: Queue, publisher: Publisher, display_q: Queue, net_shape, processing_times):
+    while True:
+        frame = detections_q.get()
+        if frame is STOP:
+            break
+        stream = frame.stream
+        if config.gps_grid_step and stream.converter.grid is None:
+            stream.converter.enableGrid(frame.shape(), config.gps_grid_step, config.gps_grid_cache)
+        if frame.detections is None:
+            frame.tracks = stream.tracker.coast()
+        else:
+            frame.tracks = stream.tracker.update(frame.detections)
+        if stream.scheduler is not None:
+            stream.scheduler.record_tracks(len(frame.tracks))
+        frame.tracks_gps = convert_tracks_to_gps_arrays(stream.converter, frame.tracks, net_shape, frame.shape())
+        queue_tracks(publisher, stream.device_id, frame.capture_time, frame.tracks_gps, stream.tracker.pop_ended(), stream.delta)
+
+        if config.display:
+            put_latest(display_q, frame)
         if config.debug:
-            processing_times.append((time.time() - start_time)*1000)
-            frames += 1
+            processing_times.append((time.time() - frame.read_time)*1000)
+    publisher.close()
+    display_q.put(STOP)
 
-    cap.release()
+
+def main():
+    streams = configured_streams()
+    if config.multiprocess:
+        if len(streams) > 1:
+            print("Multiprocess mode supports a single stream.")
+            exit(1)
+        import processes
+        processes.run(streams[0])
+        return
+
+    detector = make_detector(config.batch_size)
+    net_w, net_h = detector.net_shape
+    # queued slots plus the ones held by the preprocessing and inference stages, one per ROI tile
+    tiles = config.roi_tiles[0]*config.roi_tiles[1] if config.roi else 1
+    image_pool = detector.pool(size=(config.queue_size + config.batch_size + 1)*tiles)
+
+    # one network serves every stream, each stream keeps its own tracker and calibration
+    for stream in streams:
+        stream.converter = CoordinatesConverter(stream.reference_points)
+        stream.tracker = make_tracker()
+        if config.max_detect_interval > 1:
+            stream.scheduler = DetectionInterval(config.target_fps, config.max_detect_interval, config.dense_tracks)
+        if config.motion_gate:
+            stream.motion = MotionGate(threshold=config.motion_threshold, min_area=config.motion_min_area)
+        if config.delta_updates:
+            stream.delta = make_delta()
+
+    stop = mt.Event()
+    frames_qs: List[Queue] = [Queue(maxsize=config.queue_size) for _ in streams]
+    images_q: Queue = Queue(maxsize=config.queue_size)
+    detections_q: Queue = Queue(maxsize=config.queue_size)
+    display_q: Queue = Queue(maxsize=len(streams))
+    publisher = make_publisher()
+    processing_times: List[float] = []
+
+    tracking_thread = mt.Thread(target=tracking, args=(detections_q, publisher, display_q, (net_w, net_h), processing_times))
+    threads = [
+        mt.Thread(target=send_data, args=(publisher, )),
+        mt.Thread(target=preprocessing, args=(RoundRobin(frames_qs), images_q, image_pool, (net_w, net_h))),
+        mt.Thread(target=inference, args=(images_q, detections_q, detector, image_pool)),
+        tracking_thread,
+    ]
+    threads += [mt.Thread(target=capture, args=(stream, frames_q, stop)) for stream, frames_q in zip(streams, frames_qs)]
+    for thread in threads:
+        thread.start()
+
+    # OpenCV windows have to be driven from the main thread
+    if config.display:
+        while True:
+            frame = display_q.get()
+            if frame is STOP:
+                break
+            if not show(frame, frame.stream, (net_w, net_h)):
+                stop.set()
+                break
+
+    # drain the stages so none of them stays blocked on a full queue after 'q'
+    while tracking_thread.is_alive():
+        try:
+            display_q.get(timeout=0.1)
+        except Empty:
+            pass
+    for thread in threads:
+        thread.join()
+
+    image_pool.free()
     cv2.destroyAllWindows()
-    
+
     if config.debug:
+        for stream in streams:
+            if stream.scheduler is not None:
+                print(f"Device {stream.device_id} frames without detection: {stream.scheduler.skipped}")
+            if stream.motion is not None:
+                print(f"Device {stream.device_id} frames without motion: {stream.motion.skipped}")
+            if stream.delta is not None:
+                print(f"Device {stream.device_id} tracks held back by the delta mode: {stream.delta.held}")
         times = processing_times[1:]
         print("Processing time:")
         print(f"AVG: {np.mean(times)} ms, MIN: {np.min(times)} ms, MAX: {np.max(times)} ms")
@@ -0,0 +1,194 @@
+"""
+Encoding of the /tracker messages, kept identical in edge_device/payload.py
+and remote_device/aggregator/payload.py
+
+JSON: {"device_id": .., "capture_time": .., "tracks": {"<uuid>": [x, y, lat, lon]},
+       "ended": ["<uuid>", ..], "delta": true}  (ended and delta optional)
+
+Binary (version 2), little endian:
+    header  magic "BPTR", version u8, flags u8, track count u16, device_id u32, capture_time f64
+    records count x (id 16 bytes, x i16, y i16, lat f64, lon f64)
+    ended   ended count u16, ended count x id 16 bytes  (not present in version 1)
+
+A message holds every live track of the device unless it is a delta
+(flag DELTA), which only carries the tracks that moved since they were
+last sent. Ended lists the tracks the device stopped tracking.
+
+Batch of several messages of either format:
+    header  magic "BPTB", version u8, message count u16
+    count x (length u32, message)
+
+decode() tells the formats apart by the magic bytes, so both can be
+received on the same topic, decode_all() also unpacks batches.
+"""
+import json
+import struct
+import uuid
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+
+MAGIC = b"BPTR"
+VERSION = 2
+HEADER = struct.Struct("<4sBBHId")
+COUNT = struct.Struct("<H")
+DELTA = 1
+BATCH_MAGIC = b"BPTB"
+BATCH_HEADER = struct.Struct("<4sBH")
+LENGTH = struct.Struct("<I")
+RECORD_DTYPE = np.dtype([("id", "V16"), ("x", "<i2"), ("y", "<i2"), ("lat", "<f8"), ("lon", "<f8")])
+
+
+class TrackMessage:
+    """
+    One decoded message with the tracks stored column by column
+    """
+    def __init__(self, device_id: int, capture_time: float, ids: List[str],
+                 x: np.ndarray, y: np.ndarray, lat: np.ndarray, lon: np.ndarray,
+                 ended: Sequence[str] = (), delta: bool = False) -> None:
+        self.device_id = device_id
+        self.capture_time = capture_time
+        self.ids = ids
+        self.x = x
+        self.y = y
+        self.lat = lat
+        self.lon = lon
+        self.ended = list(ended)
+        self.delta = delta
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def rows(self) -> Iterator[Tuple[str, int, int, float, float]]:
+        yield from zip(self.ids, self.x.tolist(), self.y.tolist(), self.lat.tolist(), self.lon.tolist())
+
+
+def uuid_bytes(ids: Sequence) -> List[bytes]:
+    return [id.bytes if isinstance(id, uuid.UUID) else uuid.UUID(str(id)).bytes for id in ids]
+
+
+def encode_json(device_id: int, capture_time: float, ids: Sequence, xy: np.ndarray, latlon: np.ndarray,
+                ended: Sequence = (), delta: bool = False) -> str:
+    payload = {
+        "device_id": device_id,
+        "capture_time": capture_time,
+        "tracks": {},
+    }
+    for id, (x, y), (lat, lon) in zip(ids, xy.tolist(), latlon.tolist()):
+        payload["tracks"][str(id)] = [x, y, lat, lon]
+    if len(ended):
+        payload["ended"] = [str(id) for id in ended]
+    if delta:
+        payload["delta"] = True
+    return json.dumps(payload)
+
+
+def encode_binary(device_id: int, capture_time: float, ids: Sequence, xy: np.ndarray, latlon: np.ndarray,
+                  ended: Sequence = (), delta: bool = False) -> bytes:
+    records = np.empty(len(ids), dtype=RECORD_DTYPE)
+    records["id"] = uuid_bytes(ids)
+    records["x"] = xy[:, 0]
+    records["y"] = xy[:, 1]
+    records["lat"] = latlon[:, 0]
+    records["lon"] = latlon[:, 1]
+    flags = DELTA if delta else 0
+    return b"".join([HEADER.pack(MAGIC, VERSION, flags, len(ids), device_id, capture_time), records.tobytes(),
+                     COUNT.pack(len(ended)), *uuid_bytes(ended)])
+
+
+def encode(payload_format: str, device_id: int, capture_time: float, ids: Sequence, xy: np.ndarray, latlon: np.ndarray,
+           ended: Sequence = (), delta: bool = False):
+    if payload_format == "binary":
+        return encode_binary(device_id, capture_time, ids, xy, latlon, ended, delta)
+    return encode_json(device_id, capture_time, ids, xy, latlon, ended, delta)
+
+
+def decode_json(data: bytes) -> TrackMessage:
+    payload = json.loads(data)
+    tracks = payload["tracks"]
+    values = np.array(list(tracks.values()), dtype=np.float64).reshape(-1, 4)
+    return TrackMessage(payload["device_id"], payload["capture_time"], list(tracks.keys()),
+                        values[:, 0].astype(int), values[:, 1].astype(int), values[:, 2], values[:, 3],
+                        payload.get("ended", ()), payload.get("delta", False))
+
+
+def uuid_strings(raw: bytes) -> List[str]:
+    # formatting the hex string directly is several times faster than going through uuid.UUID
+    h = raw.hex()
+    return [f"{h[i:i + 8]}-{h[i + 8:i + 12]}-{h[i + 12:i + 16]}-{h[i + 16:i + 20]}-{h[i + 20:i + 32]}"
+            for i in range(0, len(h), 32)]
+
+
+def decode_binary(data: bytes) -> TrackMessage:
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated payload header")
+    magic, version, flags, count, device_id, capture_time = HEADER.unpack_from(data)
+    if version > VERSION:
+        raise ValueError(f"Unsupported payload version {version}")
+    records = np.frombuffer(data, dtype=RECORD_DTYPE, count=count, offset=HEADER.size)
+    ids = uuid_strings(records["id"].tobytes())
+
+    ended: List[str] = []
+    if version >= 2:
+        offset = HEADER.size + records.nbytes
+        if len(data) < offset + COUNT.size:
+            raise ValueError("Truncated payload")
+        ended_count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        ended = uuid_strings(data[offset:offset + 16*ended_count])
+
+    # the columns stay views into the message
+    return TrackMessage(device_id, capture_time, ids, records["x"], records["y"], records["lat"], records["lon"],
+                        ended, bool(flags & DELTA))
+
+
+def decode(data: bytes) -> TrackMessage:
+    if data[:len(MAGIC)] == MAGIC:
+        return decode_binary(data)
+    return decode_json(data)
+
+
+def device_id(data: bytes) -> int:
+    """
+    Device of a message, of the first message of a batch, without decoding the tracks
+    """
+    if data[:len(BATCH_MAGIC)] == BATCH_MAGIC:
+        offset = BATCH_HEADER.size + LENGTH.size
+        data = data[offset:offset + LENGTH.unpack_from(data, BATCH_HEADER.size)[0]]
+    if data[:len(MAGIC)] == MAGIC:
+        return HEADER.unpack_from(data)[4]
+    return json.loads(data)["device_id"]
+
+
+def encode_batch(messages: Sequence[bytes]) -> bytes:
+    parts = [BATCH_HEADER.pack(BATCH_MAGIC, VERSION, len(messages))]
+    for message in messages:
+        parts.append(LENGTH.pack(len(message)))
+        parts.append(message)
+    return b"".join(parts)
+
+
+def decode_all(data: bytes) -> List[TrackMessage]:
+    """
+    Every message in data, a single message gives a list of one
+    """
+    if data[:len(BATCH_MAGIC)] != BATCH_MAGIC:
+        return [decode(data)]
+    if len(data) < BATCH_HEADER.size:
+        raise ValueError("Truncated batch header")
+    _, version, count = BATCH_HEADER.unpack_from(data)
+    if version > VERSION:
+        raise ValueError(f"Unsupported batch version {version}")
+
+    messages = []
+    offset = BATCH_HEADER.size
+    view = memoryview(data)
+    for _ in range(count):
+        if offset + LENGTH.size > len(data):
+            raise ValueError("Truncated batch")
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        messages.append(decode(bytes(view[offset:offset + length])))
+        offset += length
+    return messages
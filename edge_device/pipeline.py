@@ -0,0 +1,113 @@
+from queue import Empty, Full, Queue
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+STOP = None
+
+
+class Frame:
+    def __init__(self, capture_time: float, image: Optional[np.ndarray], frame_shape: Optional[Tuple[int, int]] = None) -> None:
+        self.capture_time = capture_time
+        self.image = image
+        self.frame_shape = frame_shape if image is None else (image.shape[1], image.shape[0])
+        self.index: int = -1
+        self.stream: Any = None
+        self.read_time: float = 0
+        self.slots: List = []
+        self.detections: Optional[np.ndarray] = None
+        self.tracks: Optional[np.ndarray] = None
+        self.tracks_gps: Any = None
+
+    def shape(self) -> Tuple[int, int]:
+        return self.frame_shape
+
+
+def put_latest(q: Queue, item, on_drop: Optional[Callable] = None) -> int:
+    """
+    Put item into a bounded queue, dropping the oldest queued items
+    instead of blocking when it is full ("latest frame wins").
+    Returns the number of dropped items.
+    """
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except Full:
+            try:
+                old = q.get_nowait()
+                dropped += 1
+                if on_drop is not None:
+                    on_drop(old)
+            except Empty:
+                pass
+
+
+def collect_batch(q: Queue, batch_size: int, max_wait: float) -> Tuple[List, bool]:
+    """
+    Block for the first item, then keep collecting until the batch is full
+    or max_wait seconds have passed. Returns the items and whether STOP
+    was received.
+    """
+    first = q.get()
+    if first is STOP:
+        return [], True
+
+    items = [first]
+    deadline = time.time() + max_wait
+    while len(items) < batch_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            item = q.get(timeout=remaining)
+        except Empty:
+            break
+        if item is STOP:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+class RoundRobin:
+    """
+    Takes frames from the per-stream queues in turn, so a stream with
+    a faster source cannot starve the others of inference time.
+    Returns STOP once every stream has ended.
+    """
+    def __init__(self, queues: List[Queue], wait: float = 0.005) -> None:
+        self.queues = list(queues)
+        self.wait = wait
+        self.next = 0
+
+    def get(self):
+        while self.queues:
+            count = len(self.queues)
+            for i in range(count):
+                index = (self.next + i) % count
+                try:
+                    item = self.queues[index].get_nowait()
+                except Empty:
+                    continue
+                if item is STOP:
+                    self.queues.pop(index)
+                    self.next = index
+                    break
+                self.next = index + 1
+                return item
+            else:
+                # nothing ready anywhere, wait on the stream whose turn it is
+                index = self.next % count
+                try:
+                    item = self.queues[index].get(timeout=self.wait)
+                except Empty:
+                    continue
+                if item is STOP:
+                    self.queues.pop(index)
+                    continue
+                self.next = index + 1
+                return item
+        return STOP
@@ -0,0 +1,234 @@
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
+import threading as mt
+import time
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+import config
+from pipeline import STOP, Frame, put_latest
+from streams import Stream
+
+
+class FrameRing:
+    """
+    Fixed number of frame slots in shared memory. Processes pass slot
+    indexes through queues and read the frames in place, a slot goes back
+    to the free list once the last stage that needs it releases it.
+    """
+    def __init__(self, slots: int, frame_shape: Tuple[int, int]) -> None:
+        frame_w, frame_h = frame_shape
+        self.shape = (slots, frame_h, frame_w, 3)
+        self.shm = SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self.frames = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self._free: mp.Queue = mp.Queue()
+        for i in range(slots):
+            self._free.put(i)
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "shape": self.shape, "free": self._free}
+
+    def __setstate__(self, state):
+        self.shape = state["shape"]
+        self._free = state["free"]
+        self.shm = SharedMemory(name=state["name"])
+        self.frames = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    def acquire(self, block: bool = True) -> int:
+        try:
+            return self._free.get(block)
+        except Empty:
+            return -1
+
+    def release(self, index: int) -> None:
+        self._free.put(index)
+
+    def attach(self, frame: Frame) -> Frame:
+        frame.image = self.frames[frame.index]
+        return frame
+
+    def detach(self, frame: Frame) -> Frame:
+        # only the slot index crosses the process boundary, never the pixels
+        frame.image = None
+        return frame
+
+    def close(self, unlink: bool = False) -> None:
+        del self.frames
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def capture_process(stream: Stream, ring: FrameRing, infer_q: mp.Queue, stop) -> None:
+    import main
+
+    cap = main.open_capture(stream)
+    if cap is None or not cap.isOpened():
+        if cap is not None:
+            print(f"Cannot open the source of device {stream.device_id}.")
+        infer_q.put(STOP)
+        return
+    drop_frames = config.drop_frames and stream.source == "camera"
+    dropped = 0
+    resized = False
+
+    capture_time = time.time()
+    while cap.isOpened() and not stop.is_set():
+        index = ring.acquire(block=not drop_frames)
+        if index < 0:
+            # every slot is still in use downstream, skip this frame
+            cap.grab()
+            dropped += 1
+            continue
+
+        slot = ring.frames[index]
+        ret, image = cap.read(slot)
+        read_time = time.time()
+        capture_time = main.frame_time(cap, stream, capture_time, read_time)
+        if not ret:
+            ring.release(index)
+            break
+        if image is not slot:
+            # the source does not deliver the slot size (a camera ignoring camera_w/h),
+            # OpenCV allocated a new frame instead of filling the slot
+            if not resized and config.debug:
+                print(f"Source frames are {image.shape[1]}x{image.shape[0]}, resized to {ring.shape[2]}x{ring.shape[1]}")
+            resized = True
+            cv2.resize(image, (ring.shape[2], ring.shape[1]), dst=slot)
+
+        frame = Frame(capture_time, None, (ring.shape[2], ring.shape[1]))
+        frame.index = index
+        frame.read_time = read_time
+        if drop_frames:
+            # the slots rarely run out before infer_q is full, a frame still waiting
+            # for inference is replaced by the newer one and its slot is freed
+            dropped += put_latest(infer_q, frame, lambda old: ring.release(old.index))
+        else:
+            infer_q.put(frame)
+
+    cap.release()
+    infer_q.put(STOP)
+    if config.debug and drop_frames:
+        print(f"Dropped frames: {dropped}")
+
+
+def inference_process(ring: FrameRing, infer_q: mp.Queue, track_q: mp.Queue, net_q: mp.Queue) -> None:
+    import main
+
+    detector = main.make_detector(batch_size=1)
+    net_shape = detector.net_shape
+    net_q.put(net_shape)
+    image_pool = detector.pool(size=1)
+
+    while True:
+        frame = infer_q.get()
+        if frame is STOP:
+            break
+        ring.attach(frame)
+        slot = image_pool.acquire()
+        main.preprocess(frame.image, slot, net_shape)
+        frame.detections = detector.detect([slot])[0]
+        image_pool.release(slot)
+        if not config.display:
+            ring.release(frame.index)
+        track_q.put(ring.detach(frame))
+
+    track_q.put(STOP)
+    image_pool.free()
+
+
+def tracking_process(stream: Stream, ring: FrameRing, track_q: mp.Queue, display_q: mp.Queue, net_shape: Tuple[int, int]) -> None:
+    import main
+    from geotools import CoordinatesConverter
+
+    converter = CoordinatesConverter(stream.reference_points)
+    tracker = main.make_tracker()
+    publisher = main.make_publisher()
+    delta = main.make_delta() if config.delta_updates else None
+    sender = mt.Thread(target=main.send_data, args=(publisher, ))
+    sender.start()
+    processing_times: List[float] = []
+
+    while True:
+        frame = track_q.get()
+        if frame is STOP:
+            break
+        if config.gps_grid_step and converter.grid is None:
+            converter.enableGrid(frame.shape(), config.gps_grid_step, config.gps_grid_cache)
+        frame.tracks = tracker.update(frame.detections)
+        frame.tracks_gps = main.convert_tracks_to_gps_arrays(converter, frame.tracks, net_shape, frame.shape())
+        main.queue_tracks(publisher, stream.device_id, frame.capture_time, frame.tracks_gps, tracker.pop_ended(), delta)
+
+        if config.display:
+            frame.tracks_gps = None
+            put_latest(display_q, frame, on_drop=lambda old: ring.release(old.index))
+        if config.debug:
+            processing_times.append((time.time() - frame.read_time)*1000)
+
+    publisher.close()
+    display_q.put(STOP)
+    sender.join()
+
+    if config.debug:
+        times = processing_times[1:]
+        print("Processing time:")
+        print(f"AVG: {np.mean(times)} ms, MIN: {np.min(times)} ms, MAX: {np.max(times)} ms")
+        print(f"Frames: {len(times)}")
+
+
+def source_shape(stream: Stream) -> Tuple[int, int]:
+    if stream.source == "file":
+        cap = cv2.VideoCapture(stream.file_path)
+        shape = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        cap.release()
+        return shape
+    return (stream.camera_w, stream.camera_h)
+
+
+def run(stream: Stream) -> None:
+    import main
+
+    ring = FrameRing(config.ring_slots, source_shape(stream))
+    stop = mp.Event()
+    infer_q: mp.Queue = mp.Queue(maxsize=config.queue_size)
+    track_q: mp.Queue = mp.Queue(maxsize=config.queue_size)
+    display_q: mp.Queue = mp.Queue(maxsize=1)
+    net_q: mp.Queue = mp.Queue()
+
+    inference = mp.Process(target=inference_process, args=(ring, infer_q, track_q, net_q))
+    inference.start()
+    # the tracker needs the network input size, known once the weights are loaded
+    while True:
+        try:
+            net_shape = net_q.get(timeout=1)
+            break
+        except Empty:
+            if not inference.is_alive():
+                # the detector could not be created, the process has reported why
+                ring.close(unlink=True)
+                return
+    processes = [
+        mp.Process(target=capture_process, args=(stream, ring, infer_q, stop)),
+        inference,
+        mp.Process(target=tracking_process, args=(stream, ring, track_q, display_q, net_shape)),
+    ]
+    processes[0].start()
+    processes[2].start()
+
+    while True:
+        frame = display_q.get()
+        if frame is STOP:
+            break
+        if config.display:
+            if not main.show(ring.attach(frame), stream, net_shape):
+                stop.set()
+            ring.release(frame.index)
+
+    for process in processes:
+        process.join()
+
+    cv2.destroyAllWindows()
+    ring.close(unlink=True)
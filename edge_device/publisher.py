@@ -0,0 +1,198 @@
+from collections import deque
+import threading as mt
+import time
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+
+class Publisher:
+    """
+    Bounded buffer between the tracking stage and MQTT. When the broker
+    cannot keep up the oldest frames are dropped instead of growing the
+    queue without limit, frames waiting together are coalesced into one
+    message of at most max_frames frames / max_bytes bytes of encoded
+    frames (a single larger frame is sent alone), a frame never waits
+    more than max_delay seconds for others to join it. With a key
+    function only frames with the same key are coalesced, the key of the
+    last batch is kept in batch_key.
+    """
+    def __init__(self, maxlen: int, max_frames: int = 1, max_bytes: int = 16384, max_delay: float = 0.2,
+                 key: Optional[Callable] = None) -> None:
+        self.maxlen = maxlen
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.key = key
+        self.batch_key = None
+        self._items: deque = deque()
+        self._cond = mt.Condition()
+        self._closed = False
+
+        self.dropped: int = 0 # frames dropped from the full buffer
+        self.failed: int = 0 # messages the MQTT client refused
+        self.frames: int = 0
+        self.messages: int = 0
+        self.max_depth: int = 0
+
+    def put(self, item) -> None:
+        with self._cond:
+            if len(self._items) >= self.maxlen:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._cond.notify()
+
+    def close(self) -> None:
+        """
+        Frames already buffered are still handed out by next_batch
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def depth(self) -> int:
+        return len(self._items)
+
+    def next_batch(self, encode: Callable) -> List[bytes]:
+        """
+        Block for the first frame, then coalesce until a limit is reached,
+        returns the encoded frames (encode returning None skips a frame)
+        or an empty list once closed and drained
+        """
+        messages: List[bytes] = []
+        size = 0
+        deadline: Optional[float] = None
+        while len(messages) < self.max_frames:
+            with self._cond:
+                while not self._items and not self._closed:
+                    if deadline is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if not self._items:
+                    break
+                if self.key is not None:
+                    if deadline is None:
+                        self.batch_key = self.key(self._items[0])
+                    elif self.key(self._items[0]) != self.batch_key:
+                        break
+                item = self._items.popleft()
+
+            message = encode(item)
+            if message is None:
+                continue
+            if isinstance(message, str):
+                message = message.encode()
+            if messages and size + len(message) > self.max_bytes:
+                # the frame starts the next batch, it is encoded again then
+                with self._cond:
+                    self._items.appendleft(item)
+                break
+            messages.append(message)
+            size += len(message)
+            if deadline is None:
+                deadline = time.time() + self.max_delay
+        return messages
+
+    def sent(self, frames: int, ok: bool) -> None:
+        self.frames += frames
+        self.messages += 1
+        if not ok:
+            self.failed += 1
+
+
+class InFlight:
+    """
+    MQTT messages handed to paho and not written to the socket yet (QoS 0)
+    or not acknowledged (QoS 1/2). paho queues QoS 0 messages without a
+    limit (max_queued_messages_set only bounds QoS 1/2), so the sender
+    waits while limit messages are in flight and the frames pile up, and
+    are dropped, in the Publisher instead. QoS 0 messages paho throws
+    away on a disconnect are forgotten by disconnected().
+    """
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._messages: deque = deque() # (MQTTMessageInfo, qos)
+        self._lock = mt.Lock()
+        self.max_count: int = 0
+
+    def add(self, info, qos: int) -> None:
+        with self._lock:
+            self._prune()
+            self._messages.append((info, qos))
+            self.max_count = max(self.max_count, len(self._messages))
+
+    def _prune(self) -> None:
+        self._messages = deque(item for item in self._messages if not item[0].is_published())
+
+    def count(self) -> int:
+        with self._lock:
+            self._prune()
+            return len(self._messages)
+
+    def wait(self, connected: Callable[[], bool]) -> None:
+        """
+        Block while limit messages are in flight and the client is connected
+        """
+        while connected():
+            if self.count() < self.limit:
+                return
+            # wait_for_publish raises for messages lost with the connection
+            time.sleep(0.005)
+
+    def disconnected(self) -> None:
+        with self._lock:
+            self._messages = deque(item for item in self._messages if item[1] > 0)
+
+
+class DeltaFilter:
+    """
+    Delta mode of one stream: every keyframe_interval-th frame carries all
+    tracks, the frames in between only the tracks that are new or moved
+    more than min_move_px pixels or min_move_m metres since they were last
+    sent (a threshold of 0 is not used, with both 0 every track is sent).
+    """
+    def __init__(self, keyframe_interval: int, min_move_px: float = 0, min_move_m: float = 0) -> None:
+        self.keyframe_interval = keyframe_interval
+        self.min_move_px = min_move_px
+        self.min_move_m = min_move_m
+        self.frames: int = 0
+        self.held: int = 0 # tracks left out of delta frames
+        self._last: dict = {} # id -> (x, y, lat, lon) as last sent
+
+    def filter(self, ids, xy: np.ndarray, latlon: np.ndarray, ended: Sequence):
+        """
+        Returns the ids, xy and latlon to send and whether it is a delta frame
+        """
+        keyframe = self.frames % self.keyframe_interval == 0
+        self.frames += 1
+        if keyframe:
+            # a keyframe also forgets tracks that disappeared without an end event
+            self._last = {id: row for id, row in zip(ids, np.hstack((xy, latlon)).tolist())}
+            return ids, xy, latlon, False
+
+        for id in ended:
+            self._last.pop(id, None)
+        last = np.array([self._last.get(id, (np.nan,)*4) for id in ids], dtype=float).reshape(-1, 4)
+        known = ~np.isnan(last[:, 0])
+        held = known & bool(self.min_move_px or self.min_move_m)
+        with np.errstate(invalid="ignore"):
+            if self.min_move_px:
+                held &= np.hypot(*(xy - last[:, :2]).T) <= self.min_move_px
+            if self.min_move_m:
+                # equirectangular approximation, plenty for a few metres
+                dlat = np.radians(latlon[:, 0] - last[:, 2])
+                dlon = np.radians(latlon[:, 1] - last[:, 3]) * np.cos(np.radians(latlon[:, 0]))
+                held &= np.hypot(dlat, dlon) * 6371e3 <= self.min_move_m
+
+        send = np.flatnonzero(~held)
+        self.held += len(ids) - len(send)
+        ids, xy, latlon = ids[send], xy[send], latlon[send]
+        for id, row in zip(ids, np.hstack((xy, latlon)).tolist()):
+            self._last[id] = row
+        return ids, xy, latlon, True
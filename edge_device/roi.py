@@ -0,0 +1,85 @@
+from typing import List, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from darknet import nms_array
+
+
+Rect = Tuple[int, int, int, int]
+
+
+class Roi:
+    """
+    Region of the frame sent to the detector instead of the whole frame.
+    The bounding rectangle of the polygon (plus a margin, so vehicles at its
+    edge are not cut) is split into cols x rows overlapping tiles, each tile
+    is resized to the network input on its own. Detections are mapped back
+    to network coordinates of the full frame, the coordinate system used by
+    Sort and convert_tracks_to_gps, and kept only if their bottom centre
+    lies inside the polygon.
+    """
+    def __init__(self, polygon: Sequence[Tuple[int, int]], frame_shape: Tuple[int, int],
+                 tiles: Tuple[int, int] = (1, 1), overlap: float = 0.1, margin: int = 64) -> None:
+        frame_w, frame_h = frame_shape
+        self.frame_shape = frame_shape
+        self.polygon = np.array(polygon, dtype=np.int32).reshape(-1, 2)
+
+        self.mask = np.zeros((frame_h, frame_w), dtype=np.uint8)
+        cv2.fillPoly(self.mask, [self.polygon], 1)
+
+        x, y, w, h = cv2.boundingRect(self.polygon)
+        x1, y1 = max(x - margin, 0), max(y - margin, 0)
+        x2, y2 = min(x + w + margin, frame_w), min(y + h + margin, frame_h)
+        self.rect: Rect = (x1, y1, x2 - x1, y2 - y1)
+        self.tiles = Roi.split(self.rect, tiles, overlap)
+
+    @staticmethod
+    def split(rect: Rect, tiles: Tuple[int, int], overlap: float) -> List[Rect]:
+        x, y, w, h = rect
+        cols, rows = tiles
+        # every tile is widened by the overlap so a vehicle on a seam is whole in one of them
+        tile_w = int(np.ceil(w / (cols - (cols - 1) * overlap)))
+        tile_h = int(np.ceil(h / (rows - (rows - 1) * overlap)))
+        xs = np.linspace(x, x + w - tile_w, cols).astype(int) if cols > 1 else [x]
+        ys = np.linspace(y, y + h - tile_h, rows).astype(int) if rows > 1 else [y]
+        return [(int(tx), int(ty), min(tile_w, w), min(tile_h, h)) for ty in ys for tx in xs]
+
+    def crops(self, image: np.ndarray) -> List[np.ndarray]:
+        # views into the frame, cv2.resize reads them without a copy
+        return [image[y:y + h, x:x + w] for x, y, w, h in self.tiles]
+
+    def to_frame(self, detections: List[np.ndarray], net_shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Map the per-tile detections, in network coordinates of their tile,
+        to network coordinates of the full frame
+        """
+        net_w, net_h = net_shape
+        frame_w, frame_h = self.frame_shape
+        mapped = []
+        for (x, y, w, h), dets in zip(self.tiles, detections):
+            dets = dets.copy()
+            dets[:, [0, 2]] = (x + dets[:, [0, 2]] / net_w * w) / frame_w * net_w
+            dets[:, [1, 3]] = (y + dets[:, [1, 3]] / net_h * h) / frame_h * net_h
+            mapped.append(dets)
+        return np.concatenate(mapped) if mapped else np.empty((0, 6), dtype=np.float32)
+
+    def inside(self, detections: np.ndarray, net_shape: Tuple[int, int]) -> np.ndarray:
+        # the bottom centre is the point that is converted to GPS
+        net_w, net_h = net_shape
+        frame_w, frame_h = self.frame_shape
+        xs = ((detections[:, 0] + detections[:, 2]) / 2 / net_w * frame_w).astype(int)
+        ys = (detections[:, 3] / net_h * frame_h).astype(int)
+        xs = np.clip(xs, 0, frame_w - 1)
+        ys = np.clip(ys, 0, frame_h - 1)
+        return self.mask[ys, xs].astype(bool)
+
+    def merge(self, detections: List[np.ndarray], net_shape: Tuple[int, int], nms: float = .45) -> np.ndarray:
+        """
+        Full-frame detections of one frame from the detections of its tiles
+        """
+        dets = self.to_frame(detections, net_shape)
+        if len(self.tiles) > 1:
+            # a vehicle in the overlap of two tiles is detected twice
+            dets = nms_array(dets, nms)
+        return dets[self.inside(dets, net_shape)]
@@ -0,0 +1,91 @@
+import math
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+class DetectionInterval:
+    """
+    Decides which frames of a stream go through the detector. The detector
+    runs on every k-th frame, k grows with the measured inference time so the
+    stream keeps up with target_fps and shrinks in dense scenes, the frames in
+    between are covered by the trackers' motion model (Sort.coast).
+    """
+    def __init__(self, target_fps: float, max_interval: int, dense_tracks: int, smoothing: float = 0.1) -> None:
+        self.target_fps = target_fps
+        self.max_interval = max_interval
+        self.dense_tracks = dense_tracks
+        self.smoothing = smoothing
+        self.inference_time: float = 0
+        self.tracks: int = 0
+        self.skipped: int = 0
+        self._since_detection = max_interval
+
+    def interval(self) -> int:
+        # number of frames the source delivers while one inference runs
+        k = math.ceil(self.inference_time * self.target_fps)
+        if self.tracks >= self.dense_tracks:
+            k //= 2
+        return max(1, min(self.max_interval, k))
+
+    def should_detect(self) -> bool:
+        self._since_detection += 1
+        if self._since_detection >= self.interval():
+            self._since_detection = 0
+            return True
+        self.skipped += 1
+        return False
+
+    def record_inference(self, seconds: float) -> None:
+        if self.inference_time == 0:
+            self.inference_time = seconds
+        else:
+            self.inference_time += self.smoothing * (seconds - self.inference_time)
+
+    def record_tracks(self, count: int) -> None:
+        self.tracks = count
+
+
+class MotionGate:
+    """
+    Cheap motion check in front of the detector. Frames are shrunk to a
+    small grayscale image and compared with a running average background,
+    all buffers are allocated once and reused for every frame.
+    """
+    def __init__(self, width: int = 160, height: int = 90, threshold: int = 25, min_area: float = 0.002, learning_rate: float = 0.05) -> None:
+        self.size = (width, height)
+        self.threshold = threshold
+        self.min_pixels = max(1, int(min_area * width * height))
+        self.learning_rate = learning_rate
+        self.small = np.empty((height, width, 3), dtype=np.uint8)
+        self.gray = np.empty((height, width), dtype=np.uint8)
+        self.diff = np.empty((height, width), dtype=np.uint8)
+        self.background: Optional[np.ndarray] = None
+        self.background_u8 = np.empty((height, width), dtype=np.uint8)
+        self.skipped: int = 0
+
+    def moving(self, image: np.ndarray) -> bool:
+        # INTER_AREA would average the whole frame and costs more than everything
+        # else here, a linear downscale plus a small blur is enough against noise
+        cv2.resize(image, self.size, dst=self.small, interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        cv2.GaussianBlur(self.gray, (5, 5), 0, dst=self.gray)
+        if self.background is None:
+            # nothing to compare the first frame with, let it through
+            self.background = self.gray.astype(np.float32)
+            return True
+
+        cv2.convertScaleAbs(self.background, dst=self.background_u8)
+        cv2.absdiff(self.gray, self.background_u8, dst=self.diff)
+        cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.diff)
+        cv2.accumulateWeighted(self.gray, self.background, self.learning_rate)
+        return cv2.countNonZero(self.diff) >= self.min_pixels
+
+    def should_detect(self, image: np.ndarray, live_tracks: int) -> bool:
+        # the background is updated on every frame, even while tracks are live
+        moving = self.moving(image)
+        if moving or live_tracks > 0:
+            return True
+        self.skipped += 1
+        return False
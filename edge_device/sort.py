@@ -33,12 +33,17 @@ from filterpy.kalman import KalmanFilter
 np.random.seed(0)
 import uuid
 
+# resolved once, a failing import on every call is expensive when association runs per component
+try:
+  import lap
+except ImportError:
+  lap = None
+
 def linear_assignment(cost_matrix):
-  try:
-    import lap
+  if lap is not None:
     _, x, y = lap.lapjv(cost_matrix, extend_cost=True)
     return np.array([[y[i],i] for i in x if i >= 0]) #
-  except ImportError:
+  else:
     from scipy.optimize import linear_sum_assignment
     x, y = linear_sum_assignment(cost_matrix)
     return np.array(list(zip(x, y)))
@@ -63,6 +68,19 @@ def iou_batch(bb_test, bb_gt):
   return(o)  
 
 
+def iou_pairs(bb_a, bb_b):
+  """
+  Element-wise IOU of two equally long lists of bboxes in the form [x1,y1,x2,y2]
+  """
+  xx1 = np.maximum(bb_a[:, 0], bb_b[:, 0])
+  yy1 = np.maximum(bb_a[:, 1], bb_b[:, 1])
+  xx2 = np.minimum(bb_a[:, 2], bb_b[:, 2])
+  yy2 = np.minimum(bb_a[:, 3], bb_b[:, 3])
+  wh = np.maximum(0., xx2 - xx1) * np.maximum(0., yy2 - yy1)
+  return wh / ((bb_a[:, 2] - bb_a[:, 0]) * (bb_a[:, 3] - bb_a[:, 1])
+    + (bb_b[:, 2] - bb_b[:, 0]) * (bb_b[:, 3] - bb_b[:, 1]) - wh)
+
+
 def convert_bbox_to_z(bbox):
   """
   Takes a bounding box in the form [x1,y1,x2,y2] and returns z in the form
@@ -120,6 +138,7 @@ class KalmanBoxTracker(object):
     self.hits = 0
     self.hit_streak = 0
     self.age = 0
+    self.reported = False
 
   def update(self,bbox):
     """
@@ -145,6 +164,16 @@ class KalmanBoxTracker(object):
     self.history.append(convert_x_to_bbox(self.kf.x))
     return self.history[-1]
 
+  def coast(self):
+    """
+    Advances the state vector like predict, but for a frame the detector skipped,
+    so it does not count as a missed detection.
+    """
+    if((self.kf.x[6]+self.kf.x[2])<=0):
+      self.kf.x[6] *= 0.0
+    self.kf.predict()
+    return self.get_state()
+
   def get_state(self):
     """
     Returns the current bounding box estimate.
@@ -152,66 +181,174 @@ class KalmanBoxTracker(object):
     return convert_x_to_bbox(self.kf.x)
 
 
-def associate_detections_to_trackers(detections,trackers,iou_threshold = 0.3):
+def assign_by_iou(iou_matrix,iou_threshold):
+  """
+  Picks the (detection, tracker) index pairs for one IOU matrix, either directly when
+  every row and column has at most one candidate above the threshold or via linear_assignment
+  """
+  if min(iou_matrix.shape) > 0:
+    a = (iou_matrix > iou_threshold).astype(np.int32)
+    if a.sum(1).max() == 1 and a.sum(0).max() == 1:
+        return np.stack(np.where(a), axis=1)
+    return linear_assignment(-iou_matrix)
+  return np.empty(shape=(0,2),dtype=int)
+
+
+def gated_pairs(detections,trackers):
+  """
+  Candidate (detection, tracker) pairs whose boxes can overlap. Box centres are bucketed into
+  a grid with cells as large as the largest box, so overlapping boxes are at most one cell apart
+  and only the 3x3 neighbourhood of every detection has to be looked at.
+  """
+  boxes = np.concatenate((detections[:, :4], trackers[:, :4])).astype(float)
+  centres = (boxes[:, :2] + boxes[:, 2:4]) / 2.
+  cell = max(np.max(boxes[:, 2:4] - boxes[:, :2]), 1.)
+  cells = np.floor((centres - centres.min(axis=0)) / cell).astype(np.int64)
+  rows = cells[:, 1].max() + 3
+  keys = (cells[:, 0] + 1) * rows + cells[:, 1] + 1
+  det_keys = keys[:len(detections)]
+  trk_keys = keys[len(detections):]
+
+  order = np.argsort(trk_keys, kind='stable')
+  sorted_keys = trk_keys[order]
+  det_idx = []
+  trk_idx = []
+  for dx in (-1, 0, 1):
+    for dy in (-1, 0, 1):
+      query = det_keys + dx * rows + dy
+      lo = np.searchsorted(sorted_keys, query, 'left')
+      hi = np.searchsorted(sorted_keys, query, 'right')
+      counts = hi - lo
+      if counts.sum() == 0:
+        continue
+      d = np.repeat(np.arange(len(detections)), counts)
+      # position of every candidate inside its [lo, hi) run of sorted trackers
+      offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+      det_idx.append(d)
+      trk_idx.append(order[lo[d] + offsets])
+  if not det_idx:
+    return np.empty(0, dtype=int), np.empty(0, dtype=int)
+  return np.concatenate(det_idx), np.concatenate(trk_idx)
+
+
+def connected_components(num_nodes,u,v):
+  """
+  Labels the connected components of the graph given by the edges (u, v),
+  every node ends up labelled with the smallest node index of its component
+  """
+  labels = np.arange(num_nodes)
+  while True:
+    m = np.minimum(labels[u], labels[v])
+    new = labels.copy()
+    np.minimum.at(new, u, m)
+    np.minimum.at(new, v, m)
+    new = new[new]
+    if np.array_equal(new, labels):
+      return labels
+    labels = new
+
+
+def associate_gated(detections,trackers,iou_threshold):
+  """
+  Sparse variant of the assignment: IOU is only computed for nearby pairs and the
+  overlap graph is split into connected components that are assigned independently.
+  Gives the matches of the dense path, except where several assignments have exactly
+  the same total IOU and the solvers may pick different ones.
+  """
+  num_dets = len(detections)
+  d, t = gated_pairs(detections, trackers)
+  iou = iou_pairs(detections[d], trackers[t])
+  overlap = iou > 0
+  d, t, iou = d[overlap], t[overlap], iou[overlap]
+  if len(d) == 0:
+    return np.empty((0,2),dtype=int)
+
+  labels = connected_components(num_dets + len(trackers), d, t + num_dets)
+  edge_labels = labels[d]
+  order = np.argsort(edge_labels, kind='stable')
+  d, t, iou, edge_labels = d[order], t[order], iou[order], edge_labels[order]
+  starts = np.flatnonzero(np.r_[True, edge_labels[1:] != edge_labels[:-1]])
+  ends = np.r_[starts[1:], len(d)]
+
+  # the same shortcut as assign_by_iou on the whole matrix: only when every box has at most one
+  # candidate above the threshold the pairs are taken directly, otherwise every component is
+  # solved by linear_assignment without the shortcut (a component may prefer a pair below the
+  # threshold, which then drops the direct one), the maximum IOU assignment splits exactly
+  # along components
+  above = iou > iou_threshold
+  det_count = np.bincount(d[above], minlength=num_dets)
+  trk_count = np.bincount(t[above], minlength=len(trackers))
+  if det_count.max(initial=0) <= 1 and trk_count.max(initial=0) <= 1:
+    return np.stack((d[above], t[above]), axis=1).astype(int)
+
+  # components without a pair reaching the threshold cannot produce a match,
+  # a component of a single pair is its own assignment
+  solve = np.maximum.reduceat(iou, starts) >= iou_threshold
+  single = solve & (ends - starts == 1)
+  matches = [np.stack((d[starts[single]], t[starts[single]]), axis=1)]
+  solve &= ~single
+  for lo, hi in zip(starts[solve], ends[solve]):
+    comp_d, local_d = np.unique(d[lo:hi], return_inverse=True)
+    comp_t, local_t = np.unique(t[lo:hi], return_inverse=True)
+    sub = np.zeros((len(comp_d), len(comp_t)))
+    sub[local_d, local_t] = iou[lo:hi]
+    m = linear_assignment(-sub).astype(int).reshape(-1, 2)
+    matches.append(np.stack((comp_d[m[:, 0]], comp_t[m[:, 1]]), axis=1))
+  return np.concatenate(matches).astype(int)
+
+
+# below this many detection x tracker pairs the dense IOU matrix is cheaper than gating
+GATING_MIN_PAIRS = 10000
+
+def associate_detections_to_trackers(detections,trackers,iou_threshold = 0.3,gating = False):
   """
   Assigns detections to tracked object (both represented as bounding boxes)
 
+  With gating=True only spatially close pairs are scored and the assignment is solved
+  per connected component of overlapping boxes, which keeps it cheap with hundreds of objects
+
   Returns 3 lists of matches, unmatched_detections and unmatched_trackers
   """
   if(len(trackers)==0):
     return np.empty((0,2),dtype=int), np.arange(len(detections)), np.empty((0,5),dtype=int)
 
-  iou_matrix = iou_batch(detections, trackers)
-
-  if min(iou_matrix.shape) > 0:
-    a = (iou_matrix > iou_threshold).astype(np.int32)
-    if a.sum(1).max() == 1 and a.sum(0).max() == 1:
-        matched_indices = np.stack(np.where(a), axis=1)
-    else:
-      matched_indices = linear_assignment(-iou_matrix)
+  if gating and len(detections) * len(trackers) >= GATING_MIN_PAIRS:
+    matched_indices = associate_gated(detections, trackers, iou_threshold) if len(detections) else np.empty((0,2),dtype=int)
+    matched_iou = iou_pairs(detections[matched_indices[:,0]], trackers[matched_indices[:,1]])
   else:
-    matched_indices = np.empty(shape=(0,2))
-
-  unmatched_detections = []
-  for d, det in enumerate(detections):
-    if(d not in matched_indices[:,0]):
-      unmatched_detections.append(d)
-  unmatched_trackers = []
-  for t, trk in enumerate(trackers):
-    if(t not in matched_indices[:,1]):
-      unmatched_trackers.append(t)
+    iou_matrix = iou_batch(detections, trackers)
+    matched_indices = assign_by_iou(iou_matrix, iou_threshold).astype(int).reshape(-1, 2)
+    matched_iou = iou_matrix[matched_indices[:,0], matched_indices[:,1]]
 
   #filter out matched with low IOU
-  matches = []
-  for m in matched_indices:
-    if(iou_matrix[m[0], m[1]]<iou_threshold):
-      unmatched_detections.append(m[0])
-      unmatched_trackers.append(m[1])
-    else:
-      matches.append(m.reshape(1,2))
-  if(len(matches)==0):
-    matches = np.empty((0,2),dtype=int)
-  else:
-    matches = np.concatenate(matches,axis=0)
+  matches = matched_indices[matched_iou >= iou_threshold]
+
+  det_matched = np.zeros(len(detections), dtype=bool)
+  det_matched[matches[:,0]] = True
+  trk_matched = np.zeros(len(trackers), dtype=bool)
+  trk_matched[matches[:,1]] = True
 
-  return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+  return matches, np.flatnonzero(~det_matched), np.flatnonzero(~trk_matched)
 
 
 class Sort(object):
-  def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3):
+  def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3, gating=False):
     """
     Sets key parameters for SORT
     """
     self.max_age = max_age
     self.min_hits = min_hits
     self.iou_threshold = iou_threshold
+    self.gating = gating
     self.trackers = []
     self.frame_count = 0
+    self.ended = []
 
   def update(self, dets=np.empty((0, 5))):
     """
     Params:
       dets - a numpy array of detections in the format [[x1,y1,x2,y2,score],[x1,y1,x2,y2,score],...]
+             (extra trailing columns such as the class from darknet.detect_image(..., as_array=True) are ignored)
     Requires: this method must be called once for each frame even with empty detections (use np.empty((0, 5)) for frames without detections).
     Returns the a similar array, where the last column is the object ID.
 
@@ -229,8 +366,8 @@ class Sort(object):
         to_del.append(t)
     trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
     for t in reversed(to_del):
-      self.trackers.pop(t)
-    matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets,trks, self.iou_threshold)
+      self._end(self.trackers.pop(t))
+    matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets,trks, self.iou_threshold, self.gating)
 
     # update matched trackers with assigned detections
     for m in matched:
@@ -246,14 +383,254 @@ class Sort(object):
         if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
           # ret.append(np.concatenate((d,[trk.id+1])).reshape(1,-1)) # +1 as MOT benchmark requires positive
           ret.append(np.concatenate((d,[trk.id])).reshape(1,-1)) # +1 as MOT benchmark requires positive TODO:
+          trk.reported = True
         i -= 1
         # remove dead tracklet
         if(trk.time_since_update > self.max_age):
-          self.trackers.pop(i)
+          self._end(self.trackers.pop(i))
+    if(len(ret)>0):
+      return np.concatenate(ret)
+    return np.empty((0,5))
+
+  def coast(self):
+    """
+    Moves every tracker one frame ahead with its motion model only, for frames without detector output.
+    Returns the tracks reported by the last update at their predicted positions, in the same format.
+    """
+    ret = []
+    for trk in reversed(self.trackers):
+      d = trk.coast()[0]
+      if np.any(np.isnan(d)):
+        continue
+      if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
+        ret.append(np.concatenate((d,[trk.id])).reshape(1,-1))
+        trk.reported = True
     if(len(ret)>0):
       return np.concatenate(ret)
     return np.empty((0,5))
 
+  def _end(self, trk):
+    # only tracks that were ever returned are of interest to the receiver
+    if trk.reported:
+      self.ended.append(trk.id)
+
+  def pop_ended(self):
+    """
+    Returns the ids of the reported tracks removed since the last call.
+    """
+    ended, self.ended = self.ended, []
+    return ended
+
+# constant velocity model shared by every track of KalmanBoxBatch, same values as KalmanBoxTracker
+KF_F = np.array([[1,0,0,0,1,0,0],[0,1,0,0,0,1,0],[0,0,1,0,0,0,1],[0,0,0,1,0,0,0],  [0,0,0,0,1,0,0],[0,0,0,0,0,1,0],[0,0,0,0,0,0,1]], dtype=float)
+KF_H = np.array([[1,0,0,0,0,0,0],[0,1,0,0,0,0,0],[0,0,1,0,0,0,0],[0,0,0,1,0,0,0]], dtype=float)
+KF_R = np.eye(4)
+KF_R[2:,2:] *= 10.
+KF_P = np.eye(7)
+KF_P[4:,4:] *= 1000. #give high uncertainty to the unobservable initial velocities
+KF_P *= 10.
+KF_Q = np.eye(7)
+KF_Q[-1,-1] *= 0.01
+KF_Q[4:,4:] *= 0.01
+
+
+def convert_bboxes_to_z(bboxes):
+  """
+  Vectorized convert_bbox_to_z, takes an (N,4+) array and returns (N,4) rows of [x,y,s,r]
+  """
+  w = bboxes[:, 2] - bboxes[:, 0]
+  h = bboxes[:, 3] - bboxes[:, 1]
+  return np.stack((bboxes[:, 0] + w/2., bboxes[:, 1] + h/2., w * h, w / h), axis=1).astype(float)
+
+
+def convert_xs_to_bboxes(xs):
+  """
+  Vectorized convert_x_to_bbox, takes an (N,7) state array and returns (N,4) rows of [x1,y1,x2,y2]
+  """
+  with np.errstate(invalid='ignore'):
+    w = np.sqrt(xs[:, 2] * xs[:, 3])
+  h = xs[:, 2] / w
+  return np.stack((xs[:, 0] - w/2., xs[:, 1] - h/2., xs[:, 0] + w/2., xs[:, 1] + h/2.), axis=1)
+
+
+class KalmanBoxBatch(object):
+  """
+  Struct-of-arrays counterpart of a list of KalmanBoxTracker, all states (N,7) and
+  covariances (N,7,7) live in NumPy arrays and are predicted/updated in one step.
+  """
+  def __init__(self):
+    self.x = np.empty((0, 7))
+    self.P = np.empty((0, 7, 7))
+    self.ids = []
+    self.time_since_update = np.empty(0, dtype=int)
+    self.hits = np.empty(0, dtype=int)
+    self.hit_streak = np.empty(0, dtype=int)
+    self.age = np.empty(0, dtype=int)
+    self.reported = np.empty(0, dtype=bool)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def add(self, bboxes):
+    """
+    Starts a new track for every bbox.
+    """
+    n = len(bboxes)
+    if n == 0:
+      return
+    x = np.zeros((n, 7))
+    x[:, :4] = convert_bboxes_to_z(bboxes)
+    self.x = np.concatenate((self.x, x))
+    self.P = np.concatenate((self.P, np.broadcast_to(KF_P, (n, 7, 7))))
+    self.ids.extend(uuid.uuid4() for _ in range(n))
+    zeros = np.zeros(n, dtype=int)
+    self.time_since_update = np.concatenate((self.time_since_update, zeros))
+    self.hits = np.concatenate((self.hits, zeros))
+    self.hit_streak = np.concatenate((self.hit_streak, zeros))
+    self.age = np.concatenate((self.age, zeros))
+    self.reported = np.concatenate((self.reported, np.zeros(n, dtype=bool)))
+    KalmanBoxTracker.count += n
+
+  def keep(self, mask):
+    """
+    Drops every track where mask is False.
+    """
+    self.x = self.x[mask]
+    self.P = self.P[mask]
+    self.ids = [id for id, k in zip(self.ids, mask) if k]
+    self.time_since_update = self.time_since_update[mask]
+    self.hits = self.hits[mask]
+    self.hit_streak = self.hit_streak[mask]
+    self.age = self.age[mask]
+    self.reported = self.reported[mask]
+
+  def coast(self):
+    """
+    Advances all state vectors without counting a missed detection and returns the (N,4) bounding boxes.
+    """
+    self.x[(self.x[:, 6] + self.x[:, 2]) <= 0, 6] = 0.
+    self.x = self.x @ KF_F.T
+    self.P = KF_F @ self.P @ KF_F.T + KF_Q
+    return convert_xs_to_bboxes(self.x)
+
+  def predict(self):
+    """
+    Advances all state vectors and returns the predicted (N,4) bounding boxes.
+    """
+    boxes = self.coast()
+    self.age += 1
+    self.hit_streak[self.time_since_update > 0] = 0
+    self.time_since_update += 1
+    return boxes
+
+  def update(self, indices, bboxes):
+    """
+    Updates the tracks at indices with the observed bboxes.
+    """
+    if len(indices) == 0:
+      return
+    x = self.x[indices]
+    P = self.P[indices]
+    y = convert_bboxes_to_z(bboxes) - x @ KF_H.T
+    PHT = P @ KF_H.T
+    S = KF_H @ PHT + KF_R
+    K = PHT @ np.linalg.inv(S)
+    self.x[indices] = x + np.einsum('nij,nj->ni', K, y)
+    I_KH = np.eye(7) - K @ KF_H
+    self.P[indices] = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ KF_R @ K.transpose(0, 2, 1)
+
+    self.time_since_update[indices] = 0
+    self.hits[indices] += 1
+    self.hit_streak[indices] += 1
+
+  def get_state(self):
+    """
+    Returns the current (N,4) bounding box estimates.
+    """
+    return convert_xs_to_bboxes(self.x)
+
+
+class BatchSort(object):
+  def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3, gating=False):
+    """
+    Drop-in replacement for Sort that keeps its tracks in a KalmanBoxBatch,
+    returns the same tracks as Sort for the same detections
+    """
+    self.max_age = max_age
+    self.min_hits = min_hits
+    self.iou_threshold = iou_threshold
+    self.gating = gating
+    self.trackers = KalmanBoxBatch()
+    self.frame_count = 0
+    self.ended = []
+
+  def update(self, dets=np.empty((0, 5))):
+    """
+    Same contract as Sort.update.
+    """
+    self.frame_count += 1
+    # get predicted locations from existing trackers.
+    trks = np.zeros((len(self.trackers), 5))
+    trks[:, :4] = self.trackers.predict()
+    valid = ~np.any(np.isnan(trks), axis=1)
+    if not valid.all():
+      trks = trks[valid]
+      self._keep(valid)
+    matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets,trks, self.iou_threshold, self.gating)
+
+    # update matched trackers with assigned detections
+    self.trackers.update(matched[:, 1], dets[matched[:, 0], :4])
+
+    # create and initialise new trackers for unmatched detections
+    self.trackers.add(dets[unmatched_dets.astype(int), :4])
+
+    # trackers are reported and pruned newest first, like Sort
+    d = self.trackers.get_state()
+    tsu = self.trackers.time_since_update
+    report = (tsu < 1) & ((self.trackers.hit_streak >= self.min_hits) | (self.frame_count <= self.min_hits))
+    report_idx = np.flatnonzero(report)[::-1]
+    ret = np.empty((len(report_idx), 5), dtype=object)
+    ret[:, :4] = d[report_idx]
+    ret[:, 4] = [self.trackers.ids[i] for i in report_idx]
+    self.trackers.reported |= report
+
+    # remove dead tracklet
+    alive = tsu <= self.max_age
+    if not alive.all():
+      self._keep(alive)
+    if(len(ret)>0):
+      return ret
+    return np.empty((0,5))
+
+  def coast(self):
+    """
+    Same contract as Sort.coast.
+    """
+    d = self.trackers.coast()
+    report = (self.trackers.time_since_update < 1) & ((self.trackers.hit_streak >= self.min_hits) | (self.frame_count <= self.min_hits))
+    report &= ~np.any(np.isnan(d), axis=1)
+    report_idx = np.flatnonzero(report)[::-1]
+    ret = np.empty((len(report_idx), 5), dtype=object)
+    ret[:, :4] = d[report_idx]
+    ret[:, 4] = [self.trackers.ids[i] for i in report_idx]
+    self.trackers.reported |= report
+    if(len(ret)>0):
+      return ret
+    return np.empty((0,5))
+
+  def _keep(self, mask):
+    # the removed tracks, newest first like Sort
+    ended = np.flatnonzero(~mask & self.trackers.reported)[::-1]
+    self.ended.extend(self.trackers.ids[i] for i in ended)
+    self.trackers.keep(mask)
+
+  def pop_ended(self):
+    """
+    Same contract as Sort.pop_ended.
+    """
+    ended, self.ended = self.ended, []
+    return ended
+
 def parse_args():
     """Parse input arguments."""
     parser = argparse.ArgumentParser(description='SORT demo')
@@ -0,0 +1,123 @@
+import mmap
+import os
+import struct
+import threading as mt
+from typing import Optional, Tuple
+
+
+class Spool:
+    """
+    Memory-mapped ring file of MQTT messages that could not be sent while
+    the broker was unreachable. Messages are appended at the tail and
+    replayed from the head in the order they were captured, when the file
+    is full the oldest messages are overwritten, so disk usage never
+    exceeds capacity. The file survives a restart and is resumed. Records
+    are numbered in the order they leave the head (seq, counted from the
+    start of the process), peek hands out the number so pop never removes
+    a record that replaced the peeked one.
+
+    Layout: header (magic, version, capacity, head, tail, count), then
+    capacity bytes of records (length u32, message). A record that does
+    not fit before the end of the file starts at offset 0, the rest of
+    the end is marked with WRAP.
+    """
+    HEADER = struct.Struct("<4sIQQQQ")
+    LENGTH = struct.Struct("<I")
+    MAGIC = b"BPSP"
+    VERSION = 1
+    WRAP = 0xFFFFFFFF
+
+    def __init__(self, path: str, capacity: int) -> None:
+        self.capacity = capacity
+        size = Spool.HEADER.size + capacity
+        mode = "r+b" if os.path.exists(path) and os.path.getsize(path) == size else "w+b"
+        self._file = open(path, mode)
+        self._file.truncate(size)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+        self._lock = mt.Lock()
+        self.dropped: int = 0
+        self.seq: int = 0 # number of the record at the head
+
+        magic, version, file_capacity, self.head, self.tail, self.count = Spool.HEADER.unpack_from(self._mm)
+        if magic != Spool.MAGIC or version != Spool.VERSION or file_capacity != capacity:
+            self.head = self.tail = self.count = 0
+            self._write_header()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _write_header(self) -> None:
+        Spool.HEADER.pack_into(self._mm, 0, Spool.MAGIC, Spool.VERSION, self.capacity, self.head, self.tail, self.count)
+
+    def _read(self, pos: int):
+        # returns the record at pos and the position of the next one
+        if self.capacity - pos < Spool.LENGTH.size:
+            pos = 0
+        length, = Spool.LENGTH.unpack_from(self._mm, Spool.HEADER.size + pos)
+        if length == Spool.WRAP:
+            pos = 0
+            length, = Spool.LENGTH.unpack_from(self._mm, Spool.HEADER.size)
+        start = Spool.HEADER.size + pos + Spool.LENGTH.size
+        return self._mm[start:start + length], pos + Spool.LENGTH.size + length
+
+    def _fits(self, need: int) -> bool:
+        if self.count == 0:
+            self.head = self.tail = 0
+            return True
+        if self.tail > self.head:
+            return self.capacity - self.tail >= need or self.head >= need
+        # the free space is the gap between tail and head, none when they meet
+        return self.head - self.tail >= need
+
+    def _drop_oldest(self) -> None:
+        _, self.head = self._read(self.head)
+        self.count -= 1
+        self.seq += 1
+        self.dropped += 1
+
+    def append(self, data: bytes) -> bool:
+        need = Spool.LENGTH.size + len(data)
+        if need > self.capacity:
+            self.dropped += 1
+            return False
+
+        with self._lock:
+            while not self._fits(need):
+                self._drop_oldest()
+            if self.capacity - self.tail < need:
+                if self.capacity - self.tail >= Spool.LENGTH.size:
+                    Spool.LENGTH.pack_into(self._mm, Spool.HEADER.size + self.tail, Spool.WRAP)
+                self.tail = 0
+            pos = Spool.HEADER.size + self.tail
+            Spool.LENGTH.pack_into(self._mm, pos, len(data))
+            self._mm[pos + Spool.LENGTH.size:pos + need] = data
+            self.tail += need
+            self.count += 1
+            self._write_header()
+        return True
+
+    def peek(self) -> Optional[Tuple[int, bytes]]:
+        """
+        The oldest record and its number, None when the spool is empty
+        """
+        with self._lock:
+            if self.count == 0:
+                return None
+            return self.seq, self._read(self.head)[0]
+
+    def pop(self, seq: int) -> None:
+        """
+        Remove the record seq once it was sent, nothing when append already dropped it
+        """
+        with self._lock:
+            if self.count == 0 or seq != self.seq:
+                return
+            _, self.head = self._read(self.head)
+            self.count -= 1
+            self.seq += 1
+            self._write_header()
+
+    def close(self) -> None:
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()
@@ -0,0 +1,36 @@
+from typing import Any, List, Optional, Tuple
+
+from geotools import Point
+
+
+class Stream:
+    def __init__(
+        self,
+        device_id: int,
+        source: str,
+        reference_points: List[Point],
+        file_path: str = "",
+        sensor_id: int = 0,
+        camera_w: int = 1920,
+        camera_h: int = 1080,
+        roi_polygon: Optional[List[Tuple[int, int]]] = None,
+    ) -> None:
+        self.device_id = device_id
+        self.source = source # "camera" or "file"
+        self.reference_points = reference_points
+        self.file_path = file_path
+        self.sensor_id = sensor_id
+        self.camera_w = camera_w
+        self.camera_h = camera_h
+        self.roi_polygon = roi_polygon # detection area in frame pixels, the reference points' hull when empty
+
+        # per-stream processing state, created by main
+        self.converter: Any = None
+        self.tracker: Any = None
+        self.scheduler: Any = None
+        self.motion: Any = None
+        self.roi: Any = None
+        self.delta: Any = None
+
+    def name(self) -> str:
+        return f"Vehicle tracking {self.device_id}"
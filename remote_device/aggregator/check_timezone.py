@@ -0,0 +1,79 @@
+"""
+Checks that the speeds of the aggregator do not depend on the time zone of
+the process or of the database session: the points of a track are written
+like database.py writes them, the track is loaded back into a new
+TrackCache and its next point has to get the same speed as in the cache
+that stored every point. Everything runs in one transaction that is
+rolled back, the database configured in config.py is left as it was.
+
+    python check_timezone.py
+"""
+import asyncio
+import os
+import time
+import uuid
+
+import config
+from database import CREATE_POINTS_IN, INSERT_POINTS, INSERT_TRACKS, Batch, PsycopgDatabase
+from state import TrackCache
+
+TIME_ZONES = ["UTC", "Europe/Prague"]
+START = 1719835200.0 # 2024-07-01 12:00 UTC, summer time in Prague
+
+
+class Transaction:
+    """
+    fetch() of the databases on a connection that is never committed
+    """
+    def __init__(self, conn) -> None:
+        self.conn = conn
+
+    async def fetch(self, query: str, *args):
+        cursor = self.conn.cursor()
+        cursor.execute(PsycopgDatabase.sql(query), args)
+        return cursor.fetchall()
+
+
+def speeds(conn, time_zone: str):
+    os.environ["TZ"] = time_zone
+    time.tzset()
+    cursor = conn.cursor()
+    cursor.execute("SET TimeZone = %s", (time_zone, ))
+    cursor.execute(CREATE_POINTS_IN)
+
+    id = str(uuid.uuid4())
+    stored = TrackCache(config.track_history)
+    batch = Batch()
+    for n in range(10):
+        capture_time = START + 0.2*n
+        lat, lon = 50.0 + 1e-5*n, 15.0
+        batch.add_point(-1, id, capture_time, lat, lon, 0, 0, *stored.point(id, capture_time, lat, lon))
+    cursor.execute(PsycopgDatabase.sql(INSERT_TRACKS), batch.track_columns())
+    cursor.copy_expert("COPY points_in FROM STDIN", batch.copy_text())
+    cursor.execute(INSERT_POINTS)
+
+    loaded = TrackCache(config.track_history)
+    asyncio.run(loaded.load(Transaction(conn), [id]))
+    capture_time, lat, lon = START + 2, 50.0 + 1e-4, 15.0
+    return stored.point(id, capture_time, lat, lon)[1], loaded.point(id, capture_time, lat, lon)[1]
+
+
+def main():
+    conn = PsycopgDatabase.connect()
+    try:
+        results = {time_zone: speeds(conn, time_zone) for time_zone in TIME_ZONES}
+    finally:
+        conn.rollback()
+        conn.close()
+
+    ok = True
+    for time_zone, (stored, loaded) in results.items():
+        print(f"{time_zone}: stored {stored:.3f} km/h, loaded {loaded:.3f} km/h")
+        ok &= abs(stored - loaded) < 1e-3 and abs(stored - results[TIME_ZONES[0]][0]) < 1e-3
+    if not ok:
+        print("Speeds depend on the time zone.")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
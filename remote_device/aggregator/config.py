@@ -1,10 +1,26 @@
 # mqtt_host: str        = "127.0.0.1"
 mqtt_host: str      = "mosquitto"
 mqtt_port: int      = 1883
+mqtt_topic: str     = "/tracker"
 # db_host: str        = "127.0.0.1"
 db_host: str        = "db"
 db_port: int        = 5432
 db_user: str        = "bp_user"
 db_pass: str        = "bp_password"
 db_dbname: str      = "bp"
-debug: bool         = False
\ No newline at end of file
+debug: bool         = False
+track_history: int  = 20 # recent points per track the speed is averaged over
+track_idle_timeout: float = 300 # seconds without a point before a track leaves the cache
+track_timeout: float = 10 # seconds a track stays active without points, or its device without messages
+flush_rows: int     = 5000 # points buffered before they are written
+flush_interval: float = 0.5 # seconds a point waits at most before it is written
+mqtt_client: str    = "auto" # aiomqtt / paho, auto uses aiomqtt when it is installed
+db_driver: str      = "auto" # asyncpg / psycopg2, auto uses asyncpg when it is installed
+receive_queue: int  = 1000 # MQTT messages waiting for decoding
+message_queue: int  = 1000 # decoded frames waiting for the state update
+batch_queue: int    = 4 # batches waiting for a writer
+writers: int        = 1 # batches written concurrently, each writer has its own connection
+write_attempts: int = 3 # times a batch is written before its points are counted as lost
+workers: int        = 1 # aggregator workers splitting the devices by device_id % workers (sharding.py)
+worker: int         = 0 # index of this worker, launcher.py sets it for the workers it starts
+devices: list       = [] # device ids, lets a worker subscribe only to the topics of its devices
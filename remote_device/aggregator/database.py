@@ -0,0 +1,304 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+import config
+
+
+CREATE_POINTS_IN = (
+    "CREATE TEMPORARY TABLE IF NOT EXISTS points_in ("
+    " track_id uuid, captured_at double precision, latitude double precision, longitude double precision,"
+    " x integer, y integer, distance real, speed real) ON COMMIT DELETE ROWS")
+# every batch inserts the tracks it references, so batches written concurrently never
+# miss a track another one inserts (ON CONFLICT waits for it), sorted to avoid deadlocks.
+# They are inserted inactive, only UPSERT_ACTIVE activates them, a track known only
+# from stale messages (ActiveTracks ignores those) stays inactive
+INSERT_TRACKS = (
+    "INSERT INTO tracks (id, device_id, active) SELECT id, device_id, false FROM unnest($1::uuid[], $2::integer[])"
+    " AS new (id, device_id) ON CONFLICT DO NOTHING")
+# captured_at (without a time zone) holds UTC whatever the session time zone is
+INSERT_POINTS = (
+    "INSERT INTO points (track_id, captured_at, latitude, longitude, x, y, distance, speed)"
+    " SELECT track_id, to_timestamp(captured_at) AT TIME ZONE 'UTC', latitude, longitude, x, y, distance, speed"
+    " FROM points_in")
+# the active states are written by one task (main.activating) in the order they changed,
+# a track whose points were not written yet is inserted with its state. Only the rows
+# whose state changed are updated, and only of the devices of this worker ($4 workers,
+# $5 worker), so workers never change each other's tracks
+UPSERT_ACTIVE = (
+    "INSERT INTO tracks (id, device_id, active) SELECT * FROM unnest($1::uuid[], $2::integer[], $3::boolean[])"
+    " ON CONFLICT (id) DO UPDATE SET active = EXCLUDED.active"
+    " WHERE tracks.active <> EXCLUDED.active AND tracks.device_id % $4 = $5")
+
+
+class Batch:
+    """
+    Rows of many messages written in one transaction
+    """
+    def __init__(self) -> None:
+        self.tracks: Dict[str, int] = {} # track id -> device id
+        self.points: List[Tuple] = []
+        self.since: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def add_point(self, device_id: int, id: str, capture_time: float, lat: float, lon: float, x: int, y: int,
+                  distance: float, speed: float) -> None:
+        self.tracks[id] = device_id
+        self.points.append((id, capture_time, lat, lon, x, y, float(distance), float(speed)))
+        self._start()
+
+    def _start(self) -> None:
+        if self.since is None:
+            self.since = time.monotonic()
+
+    def empty(self) -> bool:
+        return self.since is None
+
+    def due(self, max_rows: int, max_delay: float) -> bool:
+        return not self.empty() and (len(self.points) >= max_rows or self.remaining(max_delay) <= 0)
+
+    def remaining(self, max_delay: float) -> float:
+        """
+        Seconds until the batch has to be written
+        """
+        if self.since is None:
+            return max_delay
+        return max(0, self.since + max_delay - time.monotonic())
+
+    def track_columns(self) -> Tuple[List[str], List[int]]:
+        ids = sorted(self.tracks)
+        return ids, [self.tracks[id] for id in ids]
+
+    def copy_text(self) -> io.StringIO:
+        # repr keeps every digit of the floats, the text COPY format accepts nan and inf
+        return io.StringIO("".join(f"{id}\t{t!r}\t{lat!r}\t{lon!r}\t{x}\t{y}\t{d!r}\t{s!r}\n"
+                                   for id, t, lat, lon, x, y, d, s in self.points))
+
+
+def active_columns(changes: Dict[str, Tuple[int, bool]]) -> Tuple[List[str], List[int], List[bool], int, int]:
+    # sorted like the tracks of the batches to avoid deadlocks
+    ids = sorted(changes)
+    return ids, [changes[id][0] for id in ids], [changes[id][1] for id in ids], config.workers, config.worker
+
+
+class FlushStats:
+    def __init__(self) -> None:
+        self.flushes: int = 0
+        self.rows: int = 0
+        self.failed: int = 0
+        self.lost: int = 0 # points of the batches given up after config.write_attempts
+        # sizes and durations (seconds) of the recent flushes
+        self.flushed_rows: deque = deque(maxlen=1000)
+        self.latencies: deque = deque(maxlen=1000)
+
+    def record(self, rows: int, seconds: float) -> None:
+        self.flushes += 1
+        self.rows += rows
+        self.flushed_rows.append(rows)
+        self.latencies.append(seconds)
+
+    def __str__(self) -> str:
+        if not self.flushes:
+            return f"FLUSHES: 0, FAILED: {self.failed}, LOST: {self.lost}"
+        rows = sorted(self.flushed_rows)
+        latencies = sorted(self.latencies)
+        return (f"FLUSHES: {self.flushes}, FAILED: {self.failed}, LOST: {self.lost}, ROWS: {self.rows}, "
+                f"ROWS AVG: {sum(rows)/len(rows):.1f}, MAX: {rows[-1]}, "
+                f"LATENCY AVG: {1000*sum(latencies)/len(latencies):.1f} ms, "
+                f"P95: {1000*latencies[int(0.95*(len(latencies) - 1))]:.1f} ms, MAX: {1000*latencies[-1]:.1f} ms")
+
+
+class PsycopgDatabase:
+    """
+    psycopg2 fallback, the blocking calls run in a thread pool, one
+    connection per writer and one for reads
+    """
+    def __init__(self, writers: int) -> None:
+        self.executor = ThreadPoolExecutor(writers + 1)
+        self.read_conn = PsycopgDatabase.connect()
+        self.write_conns: asyncio.Queue = asyncio.Queue()
+        for _ in range(writers):
+            self.write_conns.put_nowait(PsycopgDatabase.connect_writer())
+        self.stats = FlushStats()
+
+    @staticmethod
+    def connect():
+        return psycopg2.connect(
+            host=config.db_host,
+            port=config.db_port,
+            user=config.db_user,
+            password=config.db_pass,
+            dbname=config.db_dbname,
+        )
+
+    @staticmethod
+    def connect_writer():
+        conn = PsycopgDatabase.connect()
+        conn.cursor().execute(CREATE_POINTS_IN)
+        conn.commit()
+        return conn
+
+    @staticmethod
+    def sql(query: str) -> str:
+        # the queries are written with asyncpg's $n placeholders, each used once and in order
+        return re.sub(r"\$\d+", "%s", query.replace("%", "%%"))
+
+    async def fetch(self, query: str, *args) -> List[Tuple]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._fetch, query, args)
+
+    def _fetch(self, query: str, args) -> List[Tuple]:
+        if self.read_conn.closed:
+            self.read_conn = PsycopgDatabase.connect()
+        try:
+            cursor = self.read_conn.cursor()
+            cursor.execute(PsycopgDatabase.sql(query), args)
+            rows = cursor.fetchall()
+            self.read_conn.commit()
+            return rows
+        except psycopg2.Error:
+            PsycopgDatabase.rollback(self.read_conn)
+            raise
+
+    @staticmethod
+    def rollback(conn) -> None:
+        # an aborted transaction would fail everything later on the connection,
+        # a broken one is replaced before its next use
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+
+    async def write(self, batch: Batch) -> bool:
+        """
+        Returns whether the batch was written
+        """
+        start = time.perf_counter()
+        if not await self._transaction(self._write, batch, f"Writing {len(batch)} points"):
+            return False
+        self.stats.record(len(batch), time.perf_counter() - start)
+        return True
+
+    async def write_active(self, changes: Dict[str, Tuple[int, bool]]) -> bool:
+        return await self._transaction(self._write_active, changes, f"Writing {len(changes)} active states")
+
+    async def _transaction(self, fn, arg, what: str) -> bool:
+        # fn(conn, arg) runs on a write connection of the pool
+        conn = await self.write_conns.get()
+        try:
+            loop = asyncio.get_running_loop()
+            if conn.closed:
+                conn = await loop.run_in_executor(self.executor, PsycopgDatabase.connect_writer)
+            await loop.run_in_executor(self.executor, fn, conn, arg)
+            return True
+        except Exception as e:
+            PsycopgDatabase.rollback(conn)
+            self.stats.failed += 1
+            print(f"{what} failed: {e!r}")
+            return False
+        finally:
+            self.write_conns.put_nowait(conn)
+
+    def _write(self, conn, batch: Batch) -> None:
+        cursor = conn.cursor()
+        if batch.tracks:
+            cursor.execute(PsycopgDatabase.sql(INSERT_TRACKS), batch.track_columns())
+        if batch.points:
+            cursor.copy_expert("COPY points_in FROM STDIN", batch.copy_text())
+            cursor.execute(INSERT_POINTS)
+        conn.commit()
+
+    def _write_active(self, conn, changes: Dict[str, Tuple[int, bool]]) -> None:
+        conn.cursor().execute(PsycopgDatabase.sql(UPSERT_ACTIVE), active_columns(changes))
+        conn.commit()
+
+    async def close(self) -> None:
+        while not self.write_conns.empty():
+            self.write_conns.get_nowait().close()
+        self.read_conn.close()
+        self.executor.shutdown()
+
+
+class AsyncpgDatabase:
+    """
+    asyncpg pool with a connection per writer and one for reads, points
+    are sent with the binary COPY protocol
+    """
+    def __init__(self, pool) -> None:
+        self.pool = pool
+        self.stats = FlushStats()
+
+    @staticmethod
+    async def create(writers: int) -> "AsyncpgDatabase":
+        pool = await asyncpg.create_pool(
+            host=config.db_host,
+            port=config.db_port,
+            user=config.db_user,
+            password=config.db_pass,
+            database=config.db_dbname,
+            min_size=writers + 1,
+            max_size=writers + 1,
+            init=lambda conn: conn.execute(CREATE_POINTS_IN),
+        )
+        return AsyncpgDatabase(pool)
+
+    async def fetch(self, query: str, *args) -> List[Tuple]:
+        return await self.pool.fetch(query, *args)
+
+    async def write(self, batch: Batch) -> bool:
+        """
+        Returns whether the batch was written, the pool replaces broken connections
+        """
+        start = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if batch.tracks:
+                        await conn.execute(INSERT_TRACKS, *batch.track_columns())
+                    if batch.points:
+                        await conn.copy_records_to_table("points_in", records=batch.points)
+                        await conn.execute(INSERT_POINTS)
+            self.stats.record(len(batch), time.perf_counter() - start)
+            return True
+        except Exception as e:
+            # conn.transaction() has rolled back already
+            self.stats.failed += 1
+            print(f"Writing {len(batch)} points failed: {e!r}")
+            return False
+
+    async def write_active(self, changes: Dict[str, Tuple[int, bool]]) -> bool:
+        try:
+            await self.pool.execute(UPSERT_ACTIVE, *active_columns(changes))
+            return True
+        except Exception as e:
+            self.stats.failed += 1
+            print(f"Writing {len(changes)} active states failed: {e!r}")
+            return False
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+
+async def connect(writers: int):
+    """
+    asyncpg when it is installed (or config.db_driver says so), psycopg2 otherwise
+    """
+    if config.db_driver == "asyncpg" or (config.db_driver == "auto" and asyncpg is not None):
+        if asyncpg is None:
+            print("asyncpg is not installed.")
+            exit(1)
+        return await AsyncpgDatabase.create(writers)
+    return PsycopgDatabase(writers)
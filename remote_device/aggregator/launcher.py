@@ -0,0 +1,53 @@
+"""
+Starts aggregator workers as local processes, e.g. 4 workers on one host:
+
+    python launcher.py --workers 4
+
+or the same 4 workers split over two hosts:
+
+    python launcher.py --workers 4 --first 0 --count 2
+    python launcher.py --workers 4 --first 2 --count 2
+"""
+import argparse
+import multiprocessing as mp
+import os
+import signal
+
+import config
+
+
+def run_worker(worker: int, workers: int) -> None:
+    config.worker = worker
+    config.workers = workers
+    # main creates its state on import, after the worker is set
+    import main
+    main.main()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregator workers sharded by device_id")
+    parser.add_argument("--workers", type=int, default=max(config.workers, os.cpu_count() or 1),
+                        help="Workers in total (on all hosts)")
+    parser.add_argument("--first", type=int, default=0, help="Index of the first worker started here")
+    parser.add_argument("--count", type=int, default=0, help="Workers started here, 0 = up to the last one")
+    args = parser.parse_args()
+    count = args.count or args.workers - args.first
+
+    processes = [mp.Process(target=run_worker, args=(worker, args.workers))
+                 for worker in range(args.first, args.first + count)]
+    for process in processes:
+        process.start()
+
+    # the workers write what they received before exiting, SIGINT is passed on to them
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+    signal.signal(signal.SIGINT, forward)
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,113 +1,225 @@
-import datetime as dt
-import json
-import math
+import asyncio
 import signal
 import time
+import traceback
 
 import numpy as np
-import paho.mqtt.client as mqtt
-import psycopg2
 
 import config
+import database
+import payload
+import sharding
+from database import Batch
+from receiver import make_receiver
+from state import ActiveTracks, TrackCache
 
-from pprint import pprint
-client = mqtt.Client()
-
-db_conn = psycopg2.connect(
-    host=config.db_host,
-    port=config.db_port,
-    user=config.db_user,
-    password=config.db_pass,
-    dbname=config.db_dbname,
-)
-db_cursor = db_conn.cursor()
+# receiving -> raw_q -> decoding -> messages_q -> updating -> batches_q -> writing (config.writers tasks)
+#                                                 updating -> active_tracks -> activating
 
 if config.debug:
     delays = []
 
+active_tracks = ActiveTracks(config.track_timeout, config.workers, config.worker)
+track_cache = TrackCache(config.track_history, config.track_idle_timeout)
+
+
+async def decoding(raw_q: asyncio.Queue, messages_q: asyncio.Queue):
+    while (data := await raw_q.get()) is not None:
+        try:
+            messages = payload.decode_all(data)
+        except Exception as e:
+            # malformed JSON fails with KeyError / TypeError as well
+            print(f"Invalid message: {e!r}")
+            continue
+        # a coalesced MQTT message carries several frames
+        for message in messages:
+            # the plain topic reaches every worker
+            if config.workers > 1 and not sharding.owns(message.device_id):
+                continue
+            await messages_q.put(message)
+    await messages_q.put(None)
+
+
+async def updating(messages_q: asyncio.Queue, batches_q: asyncio.Queue, db, updated: asyncio.Event):
+    """
+    Computes the distances and speeds and collects the rows into batches of
+    at most config.flush_rows points, a point waits at most
+    config.flush_interval seconds before its batch is handed to the writers.
+    Sets updated after the last message.
+    """
+    batch = Batch()
+    last_eviction = time.monotonic()
+    last_expiry = time.monotonic()
+    while True:
+        try:
+            message = await asyncio.wait_for(messages_q.get(), batch.remaining(config.flush_interval))
+        except asyncio.TimeoutError:
+            pass
+        else:
+            if message is None:
+                break
+            try:
+                await store_message(message, batch, db)
+            except Exception as e:
+                print(f"Storing a message of device {message.device_id} failed: {e!r}")
 
-def haversine_distance(p1: tuple[float, float], p2: tuple[float, float]) -> float:
-    dlat = math.radians(p1[0]) - math.radians(p2[0])
-    dlon = math.radians(p1[1]) - math.radians(p2[1])
-    a = (
-        math.sin(dlat / 2) ** 2
-        + math.cos(p1[0]) * math.cos(p2[0]) * math.sin(dlon / 2) ** 2
-    )
-    c = 2 * math.asin(math.sqrt(a))
-    return c * 6371e3
+        if time.monotonic() - last_expiry > 1:
+            active_tracks.expire()
+            last_expiry = time.monotonic()
 
+        if batch.due(config.flush_rows, config.flush_interval):
+            await batches_q.put(batch)
+            batch = Batch()
 
-def on_connect(client, userdata, flags, rc):
-    client.subscribe("/tracker")
+        if time.monotonic() - last_eviction > config.track_idle_timeout/10:
+            track_cache.evict()
+            last_eviction = time.monotonic()
 
+    updated.set()
+    if not batch.empty():
+        await batches_q.put(batch)
+    for _ in range(config.writers):
+        await batches_q.put(None)
 
-def on_message(client, userdata, msg: mqtt.MQTTMessage):
-    payload = json.loads(msg.payload)
 
-    device_id = payload["device_id"]
-    capture_time = payload["capture_time"]
-    tracks_ids = list(payload["tracks"].keys())
+async def store_message(message: payload.TrackMessage, batch: Batch, db):
+    device_id = message.device_id
+    capture_time = message.capture_time
+    tracks_ids = message.ids
 
-    db_cursor.execute("SELECT id FROM tracks WHERE id IN %s", (tuple(tracks_ids), ))
-    existing_tracks = [t[0] for t in db_cursor.fetchall()]
-    new_tracks_ids = list(set(tracks_ids).difference(existing_tracks))
+    active_tracks.update(device_id, capture_time, tracks_ids, message.ended, message.delta)
 
-    for new_track in new_tracks_ids:
-        sql = "INSERT INTO tracks (id, device_id) VALUES(%s, %s)"
-        db_cursor.execute(sql, (new_track, device_id, ))
+    # only tracks the cache has not seen yet (or evicted) are read from the database
+    missing = track_cache.missing(tracks_ids)
+    if missing:
+        await track_cache.load(db, missing)
 
-    db_cursor.execute("UPDATE tracks SET active = id IN %s WHERE 1=1", (tuple(tracks_ids), ))
+    for id, x, y, lat, lon in message.rows():
+        dist, speed = track_cache.point(id, capture_time, lat, lon)
+        batch.add_point(device_id, id, capture_time, lat, lon, x, y, dist, speed)
 
+    if config.debug:
+        delays.append(time.time() - capture_time)
 
-    for id, p in payload["tracks"].items():
-        db_cursor.execute("SELECT latitude, longitude, captured_at FROM points WHERE track_id = %s ORDER BY captured_at DESC", (id, ))
-        prev_position = db_cursor.fetchone()
 
-        if prev_position:
-            dist = haversine_distance((p[2], p[3]), (prev_position[0], prev_position[1]))
+async def writing(batches_q: asyncio.Queue, db):
+    """
+    A failed batch is written again (after 1, 2, ... seconds), its points
+    are counted as lost after config.write_attempts attempts
+    """
+    while (batch := await batches_q.get()) is not None:
+        for attempt in range(1, config.write_attempts + 1):
+            if await db.write(batch):
+                break
+            if attempt < config.write_attempts:
+                await asyncio.sleep(attempt)
         else:
-            dist = 0
-        
-        db_cursor.execute("SELECT distance, captured_at FROM points WHERE track_id = %s ORDER BY captured_at DESC", (id, ))
-        prev_positions = db_cursor.fetchmany(20)
-        if len(prev_positions) > 0:
-            t = [dt.datetime.timestamp(dt.datetime.utcfromtimestamp(capture_time)), ]
-            d = [dist, ]
-            for prev_pos in prev_positions:
-                t.append(prev_pos[1].timestamp())
-                d.append(prev_pos[0])
-            
-            time_delta = np.mean(np.abs(np.diff(np.array(t))))
-            avg_dist = np.mean(d)
-            speed = (avg_dist/time_delta)*3.6
-        else:
-            dist = 0
-            speed = 0
-        
-        sql = "INSERT INTO points (track_id, captured_at, latitude, longitude, x, y, distance, speed) VALUES(%s, to_timestamp(%s), %s, %s, %s, %s, %s, %s)"
-        db_cursor.execute(sql, (id, capture_time, p[2], p[3], p[0], p[1], dist, speed))
-
+            db.stats.lost += len(batch)
+
+
+async def activating(db, updated: asyncio.Event):
+    """
+    The only writer of the active states, every config.flush_interval
+    seconds, so they reach the database in the order they changed (the
+    batches of several writers may commit in any order). Changes that were
+    not written are written with the next ones, the last ones get
+    config.write_attempts attempts once updating has ended.
+    """
+    while not updated.is_set():
+        try:
+            await asyncio.wait_for(updated.wait(), config.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        await write_active(db)
+
+    for attempt in range(1, config.write_attempts + 1):
+        if await write_active(db):
+            return
+        if attempt < config.write_attempts:
+            await asyncio.sleep(attempt)
+    print(f"Active states not written: {len(active_tracks.changes())}")
+
+
+async def write_active(db) -> bool:
+    changes = active_tracks.changes()
+    if not changes or await db.write_active(changes):
+        return True
+    active_tracks.requeue(changes)
+    return False
+
+
+async def report(receiver, queues, db):
+    while True:
+        await asyncio.sleep(10)
+        depths = ", ".join(f"{name}: {queue.qsize()}/{queue.maxsize}" for name, queue in queues.items())
+        print(f"WORKER: {config.worker}/{config.workers}, RECEIVED: {receiver.received}, DROPPED: {receiver.dropped}, "
+              f"SKIPPED: {receiver.skipped}, {depths}")
+        print(db.stats)
+
+
+async def run():
+    db = await database.connect(config.writers)
+    # resume the state of the tracks that were active before a restart
+    await track_cache.load(db, await active_tracks.load(db))
+
+    raw_q = asyncio.Queue(config.receive_queue)
+    messages_q = asyncio.Queue(config.message_queue)
+    batches_q = asyncio.Queue(config.batch_queue)
+    updated = asyncio.Event()
+    stages = [
+        asyncio.create_task(decoding(raw_q, messages_q), name="decoding"),
+        asyncio.create_task(updating(messages_q, batches_q, db, updated), name="updating"),
+        asyncio.create_task(activating(db, updated), name="activating"),
+        *[asyncio.create_task(writing(batches_q, db), name=f"writing {n}") for n in range(config.writers)],
+    ]
+
+    receiver = make_receiver()
+    receiving = asyncio.create_task(receiver.run(raw_q))
+
+    # a stage only ends after the None sent by the one before it, a stage that failed
+    # would stall the queues around it, so the whole pipeline is stopped
+    failed = []
+
+    def stage_done(task: asyncio.Task) -> None:
+        if task.cancelled() or task.exception() is None:
+            return
+        e = task.exception()
+        print(f"Stage {task.get_name()} failed, stopping: {e!r}")
+        traceback.print_exception(type(e), e, e.__traceback__)
+        failed.append(task)
+        for other in [receiving, *stages]:
+            other.cancel()
+
+    for stage in stages:
+        stage.add_done_callback(stage_done)
     if config.debug:
-        delays.append(time.time() - capture_time)
-    
-    db_conn.commit()
-
+        reporting = asyncio.create_task(report(receiver, {"RAW": raw_q, "MESSAGES": messages_q, "BATCHES": batches_q}, db))
+
+    # SIGINT stops receiving, the stages write everything already received before exiting
+    asyncio.get_running_loop().add_signal_handler(signal.SIGINT, receiving.cancel)
+    try:
+        await receiving
+    except asyncio.CancelledError:
+        pass
+    if failed:
+        await asyncio.gather(*stages, return_exceptions=True)
+        await db.close()
+        print(db.stats)
+        exit(1)
+    await raw_q.put(None)
+    await asyncio.gather(*stages)
+    await db.close()
 
-def sigint_exit(signum, frame):
     if config.debug:
-        print(f"AVG: {np.mean(delays)}, MIN: {np.min(delays)}, MAX: {np.max(delays)}, MEDIAN: {np.median(delays)}")
-    client.disconnect()
-    exit()
+        reporting.cancel()
+        if delays:
+            print(f"AVG: {np.mean(delays)}, MIN: {np.min(delays)}, MAX: {np.max(delays)}, MEDIAN: {np.median(delays)}")
+        print(db.stats)
 
 
 def main():
-    signal.signal(signal.SIGINT, sigint_exit)
-    client.on_connect = on_connect
-    client.on_message = on_message
+    asyncio.run(run())
 
-    client.connect(config.mqtt_host, config.mqtt_port)
-    client.loop_forever()
-    
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+
+import paho.mqtt.client as mqtt
+
+try:
+    import aiomqtt
+except ImportError:
+    aiomqtt = None
+
+import config
+import sharding
+
+
+class AiomqttReceiver:
+    """
+    Reads the tracker topics on the event loop, keepalives are answered while the
+    later stages are busy. Messages wait in aiomqtt's queue (bounded by
+    config.receive_queue, the newest are dropped when it is full) while
+    the decoding stage does not take them.
+    """
+    def __init__(self) -> None:
+        self.received: int = 0
+        self.dropped: int = 0 # aiomqtt drops (and logs) on its own
+        self.skipped: int = 0 # devices of other workers
+
+    async def run(self, queue: asyncio.Queue) -> None:
+        while True:
+            try:
+                async with aiomqtt.Client(config.mqtt_host, config.mqtt_port,
+                                          max_queued_incoming_messages=config.receive_queue) as client:
+                    for topic in sharding.subscriptions():
+                        await client.subscribe(topic)
+                    async for message in client.messages:
+                        if not sharding.accepts(message.topic.value):
+                            self.skipped += 1
+                            continue
+                        self.received += 1
+                        await queue.put(message.payload)
+            except aiomqtt.MqttError as e:
+                print(f"MQTT connection lost: {e}")
+                await asyncio.sleep(1)
+
+
+class PahoReceiver:
+    """
+    Fallback without aiomqtt, paho's network loop runs in its own thread and
+    hands messages to the event loop, they are dropped when the queue is
+    full instead of blocking the thread that answers keepalives. The thread
+    also connects, and keeps reconnecting while the broker is down, like
+    AiomqttReceiver.
+    """
+    def __init__(self) -> None:
+        self.received: int = 0
+        self.dropped: int = 0
+        self.skipped: int = 0 # devices of other workers
+
+    async def run(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+
+        def put(data: bytes) -> None:
+            try:
+                queue.put_nowait(data)
+                self.received += 1
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+        def on_connect(client, userdata, flags, rc):
+            if rc != 0:
+                print(f"MQTT connection refused: {mqtt.connack_string(rc)}")
+                return
+            for topic in sharding.subscriptions():
+                client.subscribe(topic)
+
+        def on_disconnect(client, userdata, rc):
+            if rc != 0:
+                print(f"MQTT connection lost: {mqtt.error_string(rc)}")
+
+        def on_message(client, userdata, msg: mqtt.MQTTMessage):
+            if not sharding.accepts(msg.topic):
+                self.skipped += 1
+                return
+            loop.call_soon_threadsafe(put, msg.payload)
+
+        # paho 2 needs the callback API version, the callbacks above use the 1.x signatures
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+        else:
+            client = mqtt.Client()
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        client.on_message = on_message
+        # connect() would block the event loop and fail at once when the broker is not up yet
+        client.connect_async(config.mqtt_host, config.mqtt_port)
+        client.loop_start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            client.disconnect()
+            client.loop_stop()
+
+
+def make_receiver():
+    """
+    aiomqtt when it is installed (or config.mqtt_client says so), paho otherwise
+    """
+    if config.mqtt_client == "aiomqtt" or (config.mqtt_client == "auto" and aiomqtt is not None):
+        if aiomqtt is None:
+            print("aiomqtt is not installed.")
+            exit(1)
+        return AiomqttReceiver()
+    return PahoReceiver()
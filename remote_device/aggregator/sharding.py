@@ -0,0 +1,42 @@
+"""
+Splitting the devices between config.workers aggregator workers, worker
+config.worker handles the devices with device_id % workers == worker, so
+the state of a track always stays on one worker.
+
+Edge devices publishing to <mqtt_topic>/<device_id> are routed by topic,
+with config.devices set a worker only subscribes to the topics of its
+devices, otherwise to <mqtt_topic>/+ and skips the others without
+decoding them. Messages on the plain mqtt_topic reach every worker and
+are filtered by the device_id inside them.
+"""
+from typing import List, Optional
+
+import config
+
+
+def owns(device_id: int) -> bool:
+    return device_id % config.workers == config.worker
+
+
+def topic_device(topic: str) -> Optional[int]:
+    """
+    Device of a per-device topic, None for the plain topic
+    """
+    prefix = config.mqtt_topic + "/"
+    if topic.startswith(prefix) and topic[len(prefix):].isdigit():
+        return int(topic[len(prefix):])
+    return None
+
+
+def accepts(topic: str) -> bool:
+    device_id = topic_device(topic)
+    return device_id is None or owns(device_id)
+
+
+def subscriptions() -> List[str]:
+    topics = [config.mqtt_topic]
+    if config.devices:
+        topics += [f"{config.mqtt_topic}/{device_id}" for device_id in config.devices if owns(device_id)]
+    else:
+        topics.append(f"{config.mqtt_topic}/+")
+    return topics
@@ -0,0 +1,199 @@
+import bisect
+import math
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+def haversine_distance(p1: tuple[float, float], p2: tuple[float, float]) -> float:
+    dlat = math.radians(p1[0]) - math.radians(p2[0])
+    dlon = math.radians(p1[1]) - math.radians(p2[1])
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(p1[0]) * math.cos(p2[0]) * math.sin(dlon / 2) ** 2
+    )
+    c = 2 * math.asin(math.sqrt(a))
+    return c * 6371e3
+
+
+class TrackState:
+    """
+    What the aggregator used to read back from the points table for a track:
+    the newest position and the times and distances of the newest points
+    (newest first, at most history of them)
+    """
+    def __init__(self, history: int) -> None:
+        self.history = history
+        self.lat: float = 0
+        self.lon: float = 0
+        self.time: Optional[float] = None
+        self.times: List[float] = []
+        self.distances: List[float] = []
+        self.seen = time.monotonic()
+
+    def add(self, capture_time: float, lat: float, lon: float, distance: float) -> None:
+        if self.time is None or capture_time >= self.time:
+            self.lat, self.lon, self.time = lat, lon, capture_time
+        # late points (replayed from an edge spool) are sorted in like ORDER BY captured_at DESC would
+        i = len(self.times) - bisect.bisect_left(self.times[::-1], capture_time)
+        self.times.insert(i, capture_time)
+        self.distances.insert(i, distance)
+        del self.times[self.history:], self.distances[self.history:]
+
+
+class TrackCache:
+    """
+    Per-track state of the tracks seen recently, so that storing a point
+    needs no reads. Tracks missing from the cache are loaded from the
+    database (one query per message for all of them), tracks not seen
+    for idle_timeout seconds are evicted.
+    """
+    def __init__(self, history: int = 20, idle_timeout: float = 300) -> None:
+        self.history = history
+        self.idle_timeout = idle_timeout
+        self.tracks: Dict[str, TrackState] = {}
+        self.loads: int = 0
+
+    def missing(self, ids: Iterable[str]) -> List[str]:
+        return [id for id in ids if id not in self.tracks]
+
+    async def load(self, db, ids: List[str]) -> None:
+        """
+        Fill the cache with the newest points of the given tracks
+        """
+        self.loads += 1
+        if not ids:
+            return
+
+        # captured_at holds UTC (see INSERT_POINTS), read as epoch seconds like the capture times
+        rows = await db.fetch(
+            "SELECT track_id, latitude, longitude, EXTRACT(EPOCH FROM captured_at)::float8, distance FROM ("
+            " SELECT track_id, latitude, longitude, captured_at, distance,"
+            " row_number() OVER (PARTITION BY track_id ORDER BY captured_at DESC) AS n"
+            " FROM points WHERE track_id = ANY($1::uuid[])) p"
+            " WHERE n <= $2 ORDER BY track_id, captured_at DESC",
+            ids, self.history)
+        # the states are created once the read succeeded, a failed load is repeated by the next message
+        for id in ids:
+            self.tracks.setdefault(id, TrackState(self.history))
+        for track_id, lat, lon, captured, distance in rows:
+            state = self.tracks[str(track_id)]
+            if state.time is None:
+                state.lat, state.lon, state.time = lat, lon, captured
+            state.times.append(captured)
+            state.distances.append(distance)
+
+    def point(self, id: str, capture_time: float, lat: float, lon: float) -> Tuple[float, float]:
+        """
+        Distance to the previous point and the speed averaged over the recent
+        points, computed like the per-point queries did, and records the point
+        """
+        state = self.tracks.get(id)
+        if state is None:
+            state = self.tracks[id] = TrackState(self.history)
+        state.seen = time.monotonic()
+
+        if state.times:
+            dist = haversine_distance((lat, lon), (state.lat, state.lon))
+            t = [capture_time, *state.times]
+            d = [dist, *state.distances]
+            time_delta = np.mean(np.abs(np.diff(np.array(t))))
+            avg_dist = np.mean(d)
+            speed = (avg_dist/time_delta)*3.6
+        else:
+            dist = 0
+            speed = 0
+
+        # captured_at is stored with millisecond precision
+        state.add(round(capture_time, 3), lat, lon, dist)
+        return dist, speed
+
+    def evict(self) -> int:
+        deadline = time.monotonic() - self.idle_timeout
+        idle = [id for id, state in self.tracks.items() if state.seen < deadline]
+        for id in idle:
+            del self.tracks[id]
+        return len(idle)
+
+
+class DeviceTracks:
+    def __init__(self) -> None:
+        self.tracks: Dict[str, float] = {} # active track -> capture time it was last seen
+        self.capture_time: float = 0 # newest capture time of the device
+        self.received: float = time.monotonic()
+
+
+class ActiveTracks:
+    """
+    Which tracks of every device are active. A track is deactivated when
+    the device ends it, when a full (not delta) message no longer carries
+    it, when the device has not reported it for timeout seconds of its
+    capture time, or when nothing came from the device for timeout
+    seconds. Only the tracks whose state changed are returned by
+    changes(), so the database is only updated for them, changes that
+    could not be written are given back by requeue(). Messages older
+    than the newest one of the device (replayed from an edge spool) still
+    store their points but do not change the state, the tracks only seen
+    in them stay inactive (the points insert their tracks inactive).
+    """
+    def __init__(self, timeout: float = 10, workers: int = 1, worker: int = 0) -> None:
+        self.timeout = timeout
+        self.workers = workers
+        self.worker = worker
+        self.devices: Dict[int, DeviceTracks] = {}
+        self._changes: Dict[str, Tuple[int, bool]] = {} # track id -> device id, active
+
+    async def load(self, db) -> List[str]:
+        """
+        Resume the tracks active before a restart, they time out unless
+        reported again, returns their ids
+        """
+        rows = await db.fetch("SELECT id, device_id FROM tracks WHERE active AND device_id % $1 = $2",
+                              self.workers, self.worker)
+        for id, device_id in rows:
+            # seen at capture time 0, the first message of the device decides about them
+            self.devices.setdefault(device_id, DeviceTracks()).tracks[str(id)] = 0
+        return [str(row[0]) for row in rows]
+
+    def update(self, device_id: int, capture_time: float, ids: List[str], ended: List[str], delta: bool) -> None:
+        device = self.devices.setdefault(device_id, DeviceTracks())
+        device.received = time.monotonic()
+        if capture_time < device.capture_time:
+            return
+        device.capture_time = capture_time
+
+        if not delta:
+            self._deactivate(device_id, device, set(device.tracks).difference(ids))
+        for id in ids:
+            if id not in device.tracks:
+                self._changes[id] = (device_id, True)
+            device.tracks[id] = capture_time
+        self._deactivate(device_id, device, [id for id in ended if id in device.tracks])
+
+    def expire(self) -> None:
+        now = time.monotonic()
+        for device_id, device in self.devices.items():
+            if now - device.received > self.timeout:
+                self._deactivate(device_id, device, list(device.tracks))
+            else:
+                self._deactivate(device_id, device, [id for id, seen in device.tracks.items()
+                                                     if device.capture_time - seen > self.timeout])
+
+    def _deactivate(self, device_id: int, device: DeviceTracks, ids: Iterable[str]) -> None:
+        for id in ids:
+            del device.tracks[id]
+            self._changes[id] = (device_id, False)
+
+    def changes(self) -> Dict[str, Tuple[int, bool]]:
+        """
+        The tracks whose state changed since the last call, their device and new state
+        """
+        changes, self._changes = self._changes, {}
+        return changes
+
+    def requeue(self, changes: Dict[str, Tuple[int, bool]]) -> None:
+        """
+        Changes that were not written, a track changed again since keeps its newer state
+        """
+        self._changes = {**changes, **self._changes}